@@ -28,13 +28,23 @@
 # File hash: $Id$
 
 import argparse
+import base64
+import concurrent.futures
+import cProfile
+import glob
+import hashlib
 import json
 import logging
 import os
 import pickle
+import pstats
+import re
+import socket
 import sqlite3
 import sys
+import threading
 import time
+import tracemalloc
 import traceback
 import dataculpa
 import yaml
@@ -43,7 +53,8 @@ import dotenv
 
 import snowflake.connector
 
-from datetime import datetime, timedelta, timezone
+from datetime import date, datetime, timedelta, timezone
+from decimal import Decimal
 
 from dataculpa import DataCulpaValidator
 
@@ -78,6 +89,8 @@ def FatalError(rc, message):
 
 class Config:
     def __init__(self):
+        self.filename = None
+        self._session_history = None
         self._d = {
                     'dataculpa_controller': {
                         'protocol': 'http for local Validator or https when using Data Culpa Validator Cloud',
@@ -92,6 +105,10 @@ class Config:
                         'database': '[required] database',
                         'schema': '[optional] schema',
                         'warehouse': '[optional] warehouse',
+                        'role': '[optional] role',
+                        'fetch_mode': '[optional] default or raw',
+                        'sql_log_retention_days': 30,
+                        'sql_log_max_rows': 100000,
                         'table_list': {}
                     },
                     'dataculpa_pipeline': {
@@ -115,6 +132,7 @@ class Config:
         return
 
     def load(self, fname):
+        self.filename = fname
         with open(fname, "r") as f:
             #print(f)
             self._d = yaml.load(f, yaml.SafeLoader)
@@ -133,15 +151,46 @@ class Config:
     def get_snowflake(self):
         return self._d.get('configuration')
 
+    def get_session_history(self):
+        # each config keeps its own markers and sql_log.
+        if self._session_history is None:
+            self._session_history = SessionHistory()
+            self._session_history.set_config(self)
+        return self._session_history
+
     def get_sf_local_cache_file(self):
         return self.get_snowflake().get('session_history_cache', 'session_history_cache.db')
 
+    def get_sql_log_retention_days(self):
+        return self.get_snowflake().get('sql_log_retention_days', 30)
+
+    def get_sql_log_max_rows(self):
+        return self.get_snowflake().get('sql_log_max_rows', 100000)
+
+    def get_sf_fetch_mode(self):
+        # 'default' lets the connector convert every value; 'raw' leaves values
+        # as the strings Snowflake sends and only converts the columns we need.
+        return self.get_snowflake().get('fetch_mode', 'default')
+
+    def get_sf_max_bytes_scanned(self):
+        # default budget for every table; each table_list entry can override it.
+        return self.get_snowflake().get('max_bytes_scanned')
+
+    def get_lease_store(self):
+        return self.get_snowflake().get('lease_store')
+
+    def get_lease_ttl(self):
+        return self.get_snowflake().get('lease_ttl', 900)
+
     def get_sf_user(self):
         return self.get_snowflake().get('user')
 
     def get_sf_account(self):
         return self.get_snowflake().get('account')
 
+    def get_sf_role(self):
+        return self.get_snowflake().get('role')
+
     def get_sf_password(self):
         return os.environ.get('SNOWFLAKE_PASSWORD')
 
@@ -157,6 +206,10 @@ class Config:
     def get_sf_warehouse(self):
         return self.get_snowflake().get('warehouse')
 
+    def get_sf_warehouse_tiers(self):
+        # [{warehouse: X, max_rows: N, max_bytes: N}, ...] checked in order
+        return self.get_snowflake().get('warehouse_tiers')
+
     def get_sf_table_list(self):
         return self.get_snowflake().get('table_list')
 
@@ -169,6 +222,13 @@ class Config:
     def get_pipeline_name(self):
         return self.get_pipeline().get('name')
 
+    def get_pipeline_name_for_table(self, table_name):
+        pipeline_name = self.get_pipeline_name()
+
+        if pipeline_name.find("$TABLE") >= 0:
+            pipeline_name = pipeline_name.replace("$TABLE", table_name)
+        return pipeline_name
+
     def get_pipeline_table_is_stage(self):
         return self.get_pipeline().get('table_is_stage', False)
 
@@ -185,10 +245,7 @@ class Config:
         return False
 
     def connect_controller(self, table_name, timeshift=0):
-        pipeline_name = self.get_pipeline_name()
-
-        if pipeline_name.find("$TABLE") >= 0:
-            pipeline_name = pipeline_name.replace("$TABLE", table_name)
+        pipeline_name = self.get_pipeline_name_for_table(table_name)
 
         cc = self.get_controller()
         protocol = cc.get('protocol', 'https')
@@ -208,11 +265,26 @@ class Config:
         return v
 
 
+def NormalizeSql(sql):
+    # Statement shape for grouping the sql_log: literals become ? so that
+    # "WHERE ts > '2021-01-01'" and "WHERE ts > '2021-01-02'" count together.
+    if sql is None:
+        return None
+    sql = re.sub(r"'(?:[^']|'')*'", "?", sql)
+    sql = re.sub(r"\b\d+(?:\.\d+)?\b", "?", sql)
+    return " ".join(sql.split())
+
+
 class SessionHistory:
     def __init__(self):
         self.history = {}
         self.config = None
         self.write_enabled = True
+        self._checked_cache_path = None
+        self._dirty = set()
+        self.leases = None
+        # tables of the same config can be fetched on several threads at once.
+        self._lock = threading.RLock()
 
     def set_config(self, config):
         assert isinstance(config, Config)
@@ -223,54 +295,168 @@ class SessionHistory:
         return
 
     def add_history(self, table_name, field, value):
+        # markers are stored under ShardKey, so configs that share the cache
+        # file (or the default one) keep DB_A.ORDERS and DB_B.ORDERS apart.
         assert self.config is not None
-        self.history[table_name] = (field, value)
+        key = ShardKey(self.config, table_name)
+        with self._lock:
+            self.history[key] = (field, value)
+            self._dirty.add(key)
+        return
+
+    def set_lease_store(self, leases):
+        # with --lease the markers are kept in the lease store next to each
+        # table's lease, so they move with the table from host to host.
+        self.leases = leases
         return
 
     def has_history(self, table_name):
-        return self.history.get(table_name) is not None
+        return self.get_history(table_name) is not None
 
     def get_history(self, table_name):
-        return self.history.get(table_name)
+        key = ShardKey(self.config, table_name)
+        if self.leases is not None:
+            marker = self.leases.get_marker(key)
+            if marker is not None:
+                return marker
+            # nothing in the lease store yet: fall back to a marker from
+            # before this table was run with --lease.
+        marker = self.history.get(key)
+        if marker is None:
+            # cache files from before markers were keyed by ShardKey.
+            marker = self.history.get(table_name)
+        return marker
+
+    def _connect(self, cache_path):
+        return sqlite3.connect(cache_path, timeout=30)
 
     def _get_existing_tables(self, cache_path):
         assert self.config is not None
         _tables = []
-        c = sqlite3.connect(cache_path)
+        c = self._connect(cache_path)
         r = c.execute("select name from sqlite_master where type='table' and name not like 'sqlite_%'")
         for row in r:
             _tables.append(row[0])
+        c.close()
         return _tables
 
+    def _get_existing_columns(self, c, table_name):
+        _columns = []
+        r = c.execute("pragma table_info(%s)" % table_name)
+        for row in r:
+            _columns.append(row[1])
+        return _columns
+
     def _handle_new_cache(self, cache_path):
         assert self.config is not None
+
+        # only check the schema once per cache file per process; every sql_log
+        # append used to pay for a sqlite_master scan.
+        if self._checked_cache_path == cache_path:
+            return
+
         _tables = self._get_existing_tables(cache_path)
 
-        c = sqlite3.connect(cache_path)
+        c = self._connect(cache_path)
         if "cache" not in _tables:
             c.execute("create table cache (object_name text unique, field_name text, field_value)")
 
         if "sql_log" not in _tables:
-            c.execute("create table sql_log (sql text, object_name text, Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP)")
+            c.execute("create table sql_log (sql text, object_name text, Timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, "
+                      "duration real, row_count integer, query_id text)")
+        else:
+            # older cache files only have (sql, object_name, Timestamp)
+            _columns = self._get_existing_columns(c, "sql_log")
+            for col_name, col_type in [("duration", "real"), ("row_count", "integer"), ("query_id", "text")]:
+                if col_name not in _columns:
+                    c.execute("alter table sql_log add column %s %s" % (col_name, col_type))
+            # endfor
+        # endif
+
+        c.execute("create index if not exists sql_log_object_name on sql_log (object_name)")
+        c.execute("create index if not exists sql_log_timestamp on sql_log (Timestamp)")
 
         c.commit()
+        c.close()
 
-        # endif
+        self._checked_cache_path = cache_path
 
         return
 
-    def append_sql_log(self, table_name, sql_stmt):
+    def append_sql_log(self, table_name, sql_stmt, duration=None, row_count=None, query_id=None):
         assert self.config is not None
         assert isinstance(table_name, str)
         assert isinstance(sql_stmt, str)
 
         cache_path = self.config.get_sf_local_cache_file()
-        c = sqlite3.connect(cache_path)
         self._handle_new_cache(cache_path)
-        c.execute("insert into sql_log (sql, object_name) values (?,?)", (sql_stmt, table_name))
+        c = self._connect(cache_path)
+        c.execute("insert into sql_log (sql, object_name, duration, row_count, query_id) values (?,?,?,?,?)",
+                  (sql_stmt, table_name, duration, row_count, query_id))
         c.commit()
+        c.close()
         return
 
+    def prune_sql_log(self):
+        assert self.config is not None
+
+        if not self.write_enabled:
+            return
+
+        cache_path = self.config.get_sf_local_cache_file()
+        self._handle_new_cache(cache_path)
+
+        max_age_days = self.config.get_sql_log_retention_days()
+        max_rows     = self.config.get_sql_log_max_rows()
+
+        c = self._connect(cache_path)
+        if max_age_days is not None:
+            c.execute("delete from sql_log where Timestamp < datetime('now', ?)", ("-%d days" % int(max_age_days),))
+        if max_rows is not None:
+            # rowids only grow, so keeping the newest N rows is keeping the highest N rowids.
+            c.execute("delete from sql_log where rowid <= (select rowid from sql_log order by rowid desc limit 1 offset ?)",
+                      (int(max_rows),))
+        c.commit()
+        c.close()
+        return
+
+    def get_sql_log_summary(self, table_name=None, top_n=10):
+        """Returns (slowest, most_frequent) sql_log rows, top_n per table.
+
+        Frequency is counted per statement shape (NormalizeSql), so the
+        main fetch counts as one statement even though its marker value
+        changes every run.
+        """
+        assert self.config is not None
+
+        cache_path = self.config.get_sf_local_cache_file()
+        self._handle_new_cache(cache_path)
+
+        where = ""
+        params = ()
+        if table_name is not None:
+            where = "and object_name = ? collate nocase"
+            params = (table_name,)
+
+        c = self._connect(cache_path)
+        c.create_function("normalize_sql", 1, NormalizeSql)
+        slowest = c.execute("select object_name, duration, row_count, query_id, Timestamp, sql from "
+                            "(select *, row_number() over (partition by object_name order by duration desc) as rn "
+                            " from sql_log where duration is not null %s) "
+                            "where rn <= ? order by object_name, rn" % where,
+                            params + (top_n,)).fetchall()
+        frequent = c.execute("select object_name, n, avg_duration, max_duration, template from "
+                             "(select object_name, count(*) as n, avg(duration) as avg_duration, "
+                             "        max(duration) as max_duration, template, "
+                             "        row_number() over (partition by object_name order by count(*) desc) as rn "
+                             " from (select object_name, duration, normalize_sql(sql) as template from sql_log "
+                             "       where 1=1 %s) "
+                             " group by object_name, template) "
+                             "where rn <= ? order by object_name, rn" % where,
+                             params + (top_n,)).fetchall()
+        c.close()
+        return slowest, frequent
+
     def save(self):
         assert self.config is not None
 
@@ -285,16 +471,26 @@ class SessionHistory:
 
         self._handle_new_cache(cache_path)
 
-        c = sqlite3.connect(cache_path)
-        for table, f_pair in self.history.items():
-            (fn, fv) = f_pair
-            fv_pickle = pickle.dumps(fv)
-            # Note that this might be dangerous if we add new fields later and we don't set them all...
-            #print(table, fn, fv)
-            c.execute("insert or replace into cache (object_name, field_name, field_value) values (?,?,?)",
-                      (table, fn, fv_pickle))
-
-        c.commit()
+        # Only write the markers we moved in this process; the cache file may be
+        # shared with other connector hosts, and writing back everything we
+        # loaded would clobber their newer markers with our stale copies.
+        with self._lock:
+            c = self._connect(cache_path)
+            for key in self._dirty:
+                (fn, fv) = self.history[key]
+                fv_pickle = pickle.dumps(fv)
+                # Note that this might be dangerous if we add new fields later and we don't set them all...
+                #print(key, fn, fv)
+                c.execute("insert or replace into cache (object_name, field_name, field_value) values (?,?,?)",
+                          (key, fn, fv_pickle))
+                if self.leases is not None:
+                    self.leases.save_marker(key, fn, fv)
+
+            c.commit()
+            c.close()
+
+            self._dirty.clear()
+        # endwith
 
         return
 
@@ -307,37 +503,157 @@ class SessionHistory:
 
         self._handle_new_cache(cache_path)
 
-        c = sqlite3.connect(cache_path)
-        r = c.execute("select object_name, field_name, field_value from cache")
-        for row in r:
-            (table, fn, fv_pickle) = row
-            fv = pickle.loads(fv_pickle)
-            self.add_history(table, fn, fv)
-        # endfor
+        with self._lock:
+            c = self._connect(cache_path)
+            r = c.execute("select object_name, field_name, field_value from cache")
+            for row in r:
+                (key, fn, fv_pickle) = row
+                if key in self._dirty:
+                    continue
+                fv = pickle.loads(fv_pickle)
+                self.history[key] = (fn, fv)
+            # endfor
+            c.close()
+        # endwith
         return
 
 
-gCache = SessionHistory()
-
 def ConnectToSnowflake(config):
     logger.info("connecting...")
+
+    extra_args = {}
+    if config.get_sf_role() is not None:
+        extra_args['role'] = config.get_sf_role()
+    if config.get_sf_fetch_mode() == 'raw':
+        from snowflake.connector.converter_null import SnowflakeNoConverterToPython
+        extra_args['converter_class'] = SnowflakeNoConverterToPython
+        # the converter class is only consulted for JSON results; arrow results
+        # are converted in the connector's C extension regardless.
+        extra_args['session_parameters'] = { 'PYTHON_CONNECTOR_QUERY_RESULT_FORMAT': 'JSON' }
+    # endif
+
     # Gets the version
     sf_context = snowflake.connector.connect(
         user=config.get_sf_user(),
         password=config.get_sf_password(),
-        account=config.get_sf_account()
+        account=config.get_sf_account(),
+        **extra_args
         ) # FIXME: add region?
 #    cs = sf_context.cursor()
 
+    # USE warehouse sticks to the session, so remember the warehouse it started
+    # on; see UseTableWarehouse.
+    cs = sf_context.cursor()
+    cs.execute("select current_warehouse()")
+    sf_context.dc_default_warehouse = cs.fetchone()[0]
+    cs.close()
+
     return sf_context
 
 
-def UseWarehouseDatabaseFromConfig(config, cursor):
+class SessionPool:
+    """Authenticated Snowflake sessions shared by every config in a run.
+
+    Configs with the same account, user, role and fetch_mode reuse each
+    other's sessions instead of logging in again. A session goes to one table
+    at a time, because USE and ALTER SESSION apply to the whole session. The
+    pool therefore never opens more sessions per login than the run's
+    concurrency. Each table sets the session's warehouse, database and query
+    tag again before it runs (see UseTableWarehouse), so nothing carries over
+    from the previous config's table.
+    """
+
+    def __init__(self):
+        self._idle = {}
+        self._all = []
+        self._lock = threading.Lock()
+
+    def _key(self, config):
+        return (config.get_sf_account(), config.get_sf_user(), config.get_sf_role(), config.get_sf_fetch_mode())
+
+    def acquire(self, config):
+        key = self._key(config)
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop()
+        # endwith
+
+        sf_context = ConnectToSnowflake(config)
+        with self._lock:
+            self._all.append(sf_context)
+        return sf_context
+
+    def release(self, config, sf_context):
+        with self._lock:
+            self._idle.setdefault(self._key(config), []).append(sf_context)
+        return
+
+    def close_all(self):
+        with self._lock:
+            sessions = self._all
+            self._all = []
+            self._idle = {}
+        for sf_context in sessions:
+            CloseSnowflake(sf_context)
+        return
+
+
+# SHOW COLUMNS / SHOW TABLES results, shared by configs that look at the same
+# database in one process. Keyed by (kind, account, database, table). Configs
+# with different fetch_mode share entries, so fn must return plain values
+# that don't depend on the connection's converter (see _show_table_storage).
+gMetadataCache = {}
+gMetadataLock = threading.Lock()
+
+def CachedMetadata(kind, config, table, fn):
+    key = (kind, config.get_sf_account(), config.get_sf_database(), table.upper())
+    with gMetadataLock:
+        if key in gMetadataCache:
+            return gMetadataCache[key]
+
+    value = fn()
+    with gMetadataLock:
+        gMetadataCache[key] = value
+    return value
+
+
+def ExecuteAndLog(config, cs, table_name, sql, params=None):
+    # Run sql on the cursor and record it in the sql_log along with how long it
+    # took, how many rows came back, and the Snowflake query id so it can be
+    # found in QUERY_HISTORY later.
+    ts = time.time()
+    try:
+        if params is None:
+            cs.execute(sql)
+        else:
+            cs.execute(sql, params)
+    finally:
+        dt = time.time() - ts
+        config.get_session_history().append_sql_log(table_name, sql,
+                                                    duration=dt,
+                                                    row_count=getattr(cs, 'rowcount', None),
+                                                    query_id=getattr(cs, 'sfqid', None))
+    return dt
+
+
+def QueryTag(config, table_name):
+    # JSON so QUERY_HISTORY can be grouped with parse_json(query_tag):pipeline / :table
+    tag = json.dumps({ 'app': 'dataculpa-snowflake',
+                       'pipeline': config.get_pipeline_name_for_table(table_name),
+                       'table': table_name })
+    return tag.replace("\\", "\\\\").replace("'", "\\'")
+
+
+def UseWarehouseDatabaseFromConfig(config, cursor, table_name="(none)", warehouse=None):
+    if warehouse is None:
+        warehouse = config.get_sf_warehouse()
     try:
-        if config.get_sf_warehouse() is not None:
-            cursor.execute("USE warehouse %s" % config.get_sf_warehouse())
+        if warehouse is not None:
+            cursor.execute("USE warehouse %s" % warehouse)
         if config.get_sf_database() is not None:
             cursor.execute("USE database %s" % config.get_sf_database())
+        cursor.execute("ALTER SESSION SET QUERY_TAG = '%s'" % QueryTag(config, table_name))
 
     except Exception as e:
         logger.error(e)
@@ -345,6 +661,106 @@ def UseWarehouseDatabaseFromConfig(config, cursor):
 
     return
 
+def GetTableStorage(table, config, cs):
+    # (rows, bytes) from SHOW TABLES, which is metadata only and doesn't need a
+    # running warehouse. (None, None) for views or anything we can't find.
+    return CachedMetadata('storage', config, table, lambda: _show_table_storage(table, config, cs))
+
+
+def ShowLikePattern(name):
+    # SHOW ... LIKE treats _ and % as wildcards; escape them (and the escape
+    # character) so only the exact name matches, then quote for the literal.
+    for ch in ['\\', '_', '%']:
+        name = name.replace(ch, '\\' + ch)
+    return name.replace('\\', '\\\\').replace("'", "''")
+
+
+def _show_table_storage(table, config, cs):
+    parts = table.split(".")
+    name = parts[-1].upper()
+    if len(parts) >= 2:
+        schema = parts[-2].upper()
+        sql = "SHOW TABLES LIKE '%s' IN SCHEMA %s" % (ShowLikePattern(parts[-1]), ".".join(parts[:-1]))
+    else:
+        # we only USE the database, so an unqualified name is in PUBLIC.
+        schema = "PUBLIC"
+        sql = "SHOW TABLES LIKE '%s' IN DATABASE %s" % (ShowLikePattern(parts[-1]), config.get_sf_database())
+
+    try:
+        ExecuteAndLog(config, cs, table, sql)
+    except Exception as e:
+        logger.warning("couldn't look up storage for %s: %s", table, e)
+        return None, None
+
+    col_names = [d[0] for d in cs.description]
+    row = None
+    for r in cs.fetchall():
+        r = dict(zip(col_names, r))
+        # LIKE is case-insensitive and IN DATABASE covers every schema.
+        if str(r.get('name')).upper() == name and str(r.get('schema_name', schema)).upper() == schema:
+            row = r
+            break
+    # endfor
+    if row is None:
+        return None, None
+
+    # with fetch_mode: raw these come back as strings.
+    t_rows = row.get('rows')
+    t_bytes = row.get('bytes')
+    if t_rows is not None:
+        t_rows = int(t_rows)
+    if t_bytes is not None:
+        t_bytes = int(t_bytes)
+    return t_rows, t_bytes
+
+
+def ChooseWarehouse(table, config, cs, t_options):
+    """Picks the warehouse for a table.
+
+    An explicit warehouse on the table_list entry wins. Otherwise the first
+    warehouse_tiers entry whose max_rows and max_bytes both fit the table's
+    size is used (a missing bound matches anything), falling back to the
+    configuration's warehouse.
+    """
+    t_warehouse = t_options.get('warehouse')
+    if t_warehouse is not None:
+        return t_warehouse
+
+    tiers = config.get_sf_warehouse_tiers()
+    if not tiers:
+        return config.get_sf_warehouse()
+
+    (t_rows, t_bytes) = GetTableStorage(table, config, cs)
+    if t_rows is None and t_bytes is None:
+        return config.get_sf_warehouse()
+
+    for tier in tiers:
+        max_rows = tier.get('max_rows')
+        max_bytes = tier.get('max_bytes')
+        if max_rows is not None and (t_rows is None or t_rows > max_rows):
+            continue
+        if max_bytes is not None and (t_bytes is None or t_bytes > max_bytes):
+            continue
+        logger.info("%s: %s rows, %s bytes -> warehouse %s", table, t_rows, t_bytes, tier.get('warehouse'))
+        return tier.get('warehouse')
+    # endfor
+
+    return config.get_sf_warehouse()
+
+
+def UseTableWarehouse(table, config, sf_context, cs, t_options):
+    # Sessions are reused from table to table (and config to config) and USE
+    # lasts for the whole session, so every table sets its warehouse: its own
+    # choice, the config's, or else the one the session was opened on.
+    UseWarehouseDatabaseFromConfig(config, cs, table)
+    warehouse = ChooseWarehouse(table, config, cs, t_options)
+    if warehouse is None:
+        warehouse = getattr(sf_context, 'dc_default_warehouse', None)
+    if warehouse != config.get_sf_warehouse():
+        UseWarehouseDatabaseFromConfig(config, cs, table, warehouse)
+    return warehouse
+
+
 def DiscoverTablesAndViews(config, sf_context):
     db_name = config.get_sf_database()
     print("DiscoverTables:", db_name)
@@ -354,8 +770,7 @@ def DiscoverTablesAndViews(config, sf_context):
     UseWarehouseDatabaseFromConfig(config, cs)
 
     sql = "SHOW TABLES IN DATABASE %s" % db_name
-    gCache.append_sql_log("(none)", sql)
-    cs.execute(sql)
+    ExecuteAndLog(config, cs, "(none)", sql)
     r = cs.fetchall()
     for _r in r:
         # https://docs.snowflake.com/en/sql-reference/sql/show-tables.html
@@ -368,8 +783,7 @@ def DiscoverTablesAndViews(config, sf_context):
     # endfor
 
     sql = "SHOW VIEWS IN DATABASE %s" % db_name
-    gCache.append_sql_log("(none)", sql)
-    cs.execute(sql)
+    ExecuteAndLog(config, cs, "(none)", sql)
     r = cs.fetchall()
     view_names = []
     for _r in r:
@@ -389,10 +803,9 @@ def DiscoverTablesAndViews(config, sf_context):
 
 def DescribeTable(table, config, sf_context):
     cs = sf_context.cursor()
-    UseWarehouseDatabaseFromConfig(config, cs)
+    UseWarehouseDatabaseFromConfig(config, cs, table)
     sql = 'show columns in ' + table
-    gCache.append_sql_log(table, sql)
-    cs.execute(sql)
+    ExecuteAndLog(config, cs, table, sql)
 
     field_types = {}
     field_names = []
@@ -407,24 +820,138 @@ def DescribeTable(table, config, sf_context):
     # endfor
 
     sql = 'select count(*) from ' + table
-    gCache.append_sql_log(table, sql)
-    cs.execute(sql)
+    ExecuteAndLog(config, cs, table, sql)
     r = cs.fetchall()
     #print("table: ", r)
 
     return field_names, field_types
 
 
-def FetchTable(table, config, sf_context, t_order_by, t_initial_limit):
-    logger.info("fetching ... %s", table)
-    cs = sf_context.cursor()
-    UseWarehouseDatabaseFromConfig(config, cs)
+# first-read row limit for tables with neither initial_limit nor max_bytes_scanned.
+DEFAULT_INITIAL_LIMIT = 1000
+
+# field_name used in the SessionHistory for tables read with a change_source;
+# the value is the Snowflake timestamp (as a string) the last read ended at.
+CHANGES_MARKER = "$CHANGES"
+CHANGES_TS_FORMAT = "YYYY-MM-DD HH24:MI:SS.FF9 TZH:TZM"
+
+# Snowflake error codes for a CHANGES ... AT() that reaches further back than
+# the table keeps history for:
+#   000707: Time travel data is not available for table ...
+CHANGES_EXPIRED_ERRNOS = (707,)
+
+def ChangesMarkerExpired(e):
+    return isinstance(e, snowflake.connector.errors.Error) and e.errno in CHANGES_EXPIRED_ERRNOS
+
+def ChangesAtClause(table, t_change_source, t_options, marker_pair):
+    # Where to start reading changes from: our own marker if we have one,
+    # otherwise the stream's current offset or a configured initial_offset.
+    # Returns None if there's nothing to start from and we should do a normal
+    # (initial_limit) read instead.
+    if marker_pair is not None and marker_pair[0] == CHANGES_MARKER:
+        return "AT(TIMESTAMP => to_timestamp_tz('%s', '%s'))" % (marker_pair[1], CHANGES_TS_FORMAT)
+
+    if t_change_source == 'stream':
+        t_stream = t_options.get('stream')
+        if t_stream is None:
+            FatalError(1, "table %s has change_source: stream but no stream name configured" % table)
+            return None
+        # We only use the stream for its offset; reading a stream doesn't
+        # advance it (only DML does) and we don't want to consume somebody
+        # else's stream anyway.
+        return "AT(STREAM => '%s')" % t_stream
+
+    t_initial_offset = t_options.get('initial_offset')
+    if t_initial_offset is not None:
+        return "AT(OFFSET => -%d)" % abs(int(t_initial_offset))
+
+    return None
+
+
+# Converters for fetch_mode: raw. These take the strings Snowflake sends in
+# JSON result sets and build the same Python types the connector would.
+_EPOCH_NAIVE = datetime(1970, 1, 1)
+_EPOCH_UTC   = datetime(1970, 1, 1, tzinfo=timezone.utc)
+
+def _raw_epoch_delta(value):
+    return timedelta(microseconds=int(Decimal(value) * 1000000))
+
+def _raw_timestamp_ntz(value):
+    return _EPOCH_NAIVE + _raw_epoch_delta(value)
+
+def _raw_timestamp_ltz(value):
+    return _EPOCH_UTC + _raw_epoch_delta(value)
+
+def _raw_timestamp_tz(value):
+    (epoch, tz_offset) = value.split()
+    tzinfo = timezone(timedelta(minutes=int(tz_offset) - 1440))
+    return (_EPOCH_UTC + _raw_epoch_delta(epoch)).astimezone(tzinfo)
+
+def _raw_date(value):
+    return date(1970, 1, 1) + timedelta(days=int(value))
+
+def _raw_time(value):
+    return (_EPOCH_NAIVE + _raw_epoch_delta(value)).time()
+
+def _raw_boolean(value):
+    return value in ("1", "TRUE")
+
+_RAW_CONVERTERS = {
+    'REAL':          float,
+    'DATE':          _raw_date,
+    'TIME':          _raw_time,
+    'TIMESTAMP_NTZ': _raw_timestamp_ntz,
+    'TIMESTAMP_LTZ': _raw_timestamp_ltz,
+    'TIMESTAMP_TZ':  _raw_timestamp_tz,
+    'BOOLEAN':       _raw_boolean,
+    'BINARY':        bytes.fromhex,
+}
+
+def RawConverterForType(field_type):
+    # field_type is the data_type JSON from SHOW COLUMNS, e.g.,
+    # {"type":"FIXED","precision":38,"scale":0,"nullable":true}
+    try:
+        type_info = json.loads(field_type)
+    except (TypeError, ValueError):
+        return None
+
+    sf_type = type_info.get('type')
+    if sf_type == 'FIXED':
+        if type_info.get('scale', 0) == 0:
+            return int
+        return Decimal
+    return _RAW_CONVERTERS.get(sf_type)
+
+
+def BuildRawConverters(table, field_names, field_types, typed_columns):
+    # Returns [(column index, converter)] for the columns we actually need typed;
+    # everything else goes to the Validator as the string Snowflake sent.
+    # SHOW COLUMNS names are upper case for unquoted identifiers, so match
+    # typed_columns without regard to case.
+    wanted = set([c.upper() for c in typed_columns])
+
+    converters = []
+    for i in range(0, len(field_names)):
+        if field_names[i].upper() not in wanted:
+            continue
+        wanted.discard(field_names[i].upper())
+        fn = RawConverterForType(field_types.get(field_names[i]))
+        if fn is not None:
+            converters.append((i, fn))
+    # endfor
+
+    if wanted:
+        logger.warning("%s: typed_columns not in the table: %s", table, ", ".join(sorted(wanted)))
+    return converters
+
+
+def GetTableColumns(table, config, cs):
+    return CachedMetadata('columns', config, table, lambda: _show_columns(table, config, cs))
 
-    meta = {}
 
+def _show_columns(table, config, cs):
     sql = 'show columns in ' + table
-    gCache.append_sql_log(table, sql)
-    cs.execute('show columns in ' + table)
+    ExecuteAndLog(config, cs, table, sql)
 
     field_types = {}
     field_names = []
@@ -438,72 +965,292 @@ def FetchTable(table, config, sf_context, t_order_by, t_initial_limit):
         field_types[field_name] = field_type
     # endfor
 
-    # build select.
-    # ok we need to see if we have fetched this table before..
+    return field_names, field_types
 
-    # build up min/maxes in case it's useful for debugging.
-    if t_order_by is not None:
-        global_min_sql = "select min(%s) from %s"  % (t_order_by, table)
-        global_max_sql = "select max(%s) from %s"  % (t_order_by, table)
-        global_count   = "select count(*) from %s" % (table,)
 
-        gCache.append_sql_log(table, global_min_sql)
-        cs.execute(global_min_sql)
-        min_r = cs.fetchone()
+def ExplainSql(table, config, cs, sql):
+    # Returns the compiler's estimate for sql: {partitionsTotal, partitionsAssigned, bytesAssigned}
+    ExecuteAndLog(config, cs, table, "EXPLAIN USING TABULAR " + sql)
+    col_names = [d[0] for d in cs.description]
+    r = cs.fetchall()
 
-        gCache.append_sql_log(table, global_max_sql)
-        cs.execute(global_max_sql)
-        max_r = cs.fetchone()
+    estimate = {}
+    for rr in r:
+        row = dict(zip(col_names, rr))
+        if row.get('operation') != 'GlobalStats':
+            continue
+        for k in ['partitionsTotal', 'partitionsAssigned', 'bytesAssigned']:
+            v = row.get(k)
+            if v is not None:
+                estimate[k] = int(v)
+        # endfor
+    # endfor
+    return estimate
 
-        gCache.append_sql_log(table, global_count)
-        cs.execute(global_count)
-        count_r = cs.fetchone()
 
-        meta['min_%s' % table]   = min_r
-        meta['max_%s' % table]   = max_r
-        meta['count_%s' % table] = count_r
-    # endif
+def TableMaxBytesScanned(config, t_options):
+    return t_options.get('max_bytes_scanned', config.get_sf_max_bytes_scanned())
+
+
+def BuildFetchSql(table, config, cs, field_names, t_order_by, t_initial_limit, t_options, marker_pair,
+                  sample_pct=None, window_end=None):
+    # Returns (sql, change_end_ts, did_sql_limit) for the main select of FetchTable.
+    t_change_source = t_options.get('change_source')
 
     fields_str = ", ".join(field_names)
     sql = "select %s from %s " % (fields_str, table)
-
-    # check our history.
-    gCache.load()
+    if sample_pct is not None:
+        sql += "SAMPLE SYSTEM (%s) " % sample_pct
 
     SF_DEBUG = os.environ.get('SF_DEBUG', False)
-    did_log_sf_debug = False
     did_sql_limit = False
 
-    marker_pair = gCache.get_history(table)
-    if marker_pair is not None:
+    have_marker = False
+    change_end_ts = None
+    if t_change_source is not None:
+        # pin the end of the window so the next run starts exactly where this one stopped.
+        ExecuteAndLog(config, cs, table, "select to_varchar(current_timestamp(), '%s')" % CHANGES_TS_FORMAT)
+        change_end_ts = cs.fetchone()[0]
+
+        at_clause = ChangesAtClause(table, t_change_source, t_options, marker_pair)
+        if at_clause is not None:
+            # updates show up as a DELETE + INSERT pair; the INSERT has the new values.
+            sql += "CHANGES(INFORMATION => DEFAULT) %s END(TIMESTAMP => to_timestamp_tz('%s', '%s'))" \
+                   % (at_clause, change_end_ts, CHANGES_TS_FORMAT)
+            sql += " WHERE METADATA$ACTION = 'INSERT'"
+            have_marker = True
+        # endif
+    elif marker_pair is not None and marker_pair[0] != CHANGES_MARKER:
         (fk, fv) = marker_pair
         sql += " WHERE %s > '%s'" % (fk, fv)
+        if window_end is not None:
+            sql += " AND %s <= '%s'" % (fk, window_end)
+        have_marker = True
+    # endif
     if t_order_by is not None:
         sql += " ORDER BY %s DESC" % t_order_by
     if t_initial_limit is not None:
         # we want to do this only if we don't have a cached object for this table.
-        if not gCache.has_history(table):
+        if not have_marker:
             sql += " LIMIT %s" % t_initial_limit
             did_sql_limit = True
 
 
     if SF_DEBUG and not did_sql_limit:
         logger.warning("SF_DEBUG is set")
-        did_log_sf_debug = True
 
         sql += " LIMIT 100"
         did_sql_limit = True
     # endif
 
-    ts = time.time()
+    return sql, change_end_ts, did_sql_limit
+
+
+# how many times a window or sample is shrunk and EXPLAINed again before
+# PlanFetch gives up on the table for this run.
+BUDGET_FALLBACK_TRIES = 5
+
+def WindowEnd(fv, max_value, fraction):
+    # fraction of the way from the marker fv to max_value, or None if the
+    # column's values can't be interpolated.
+    try:
+        if not max_value > fv:
+            return None
+        span = max_value - fv
+        if isinstance(span, Decimal):
+            return fv + span * Decimal(str(fraction))
+        return fv + span * fraction
+    except TypeError:
+        return None
+
+
+def PlanFetch(table, config, cs, field_names, t_order_by, t_initial_limit, t_options, marker_pair, max_value):
+    """Builds the main select for a table and checks it against max_bytes_scanned.
+
+    Returns (sql, change_end_ts, did_sql_limit, window_end, sample_pct, estimate, note).
+    sql is None if the table should be skipped. If the plain query would scan
+    more than the budget, it falls back to the table's budget_fallback:
+    'window' reads only the next slice of desc_order_by values after the
+    marker, 'sample' reads a SYSTEM sample sized to the budget, and 'skip'
+    skips the table. The window or sample is EXPLAINed as well and shrunk
+    until it fits; if it still doesn't after BUDGET_FALLBACK_TRIES tries,
+    the table is skipped.
+
+    A sample never moves the column marker, so sampling is only used when
+    there is no marker yet; a table that already has one reads the next
+    window instead (or is skipped if no window can be worked out).
+    """
+    (sql, change_end_ts, did_sql_limit) = BuildFetchSql(table, config, cs, field_names, t_order_by, t_initial_limit,
+                                                        t_options, marker_pair)
+
+    max_bytes = TableMaxBytesScanned(config, t_options)
+    if max_bytes is None:
+        return sql, change_end_ts, did_sql_limit, None, None, None, None
+
+    estimate = ExplainSql(table, config, cs, sql)
+    est_bytes = estimate.get('bytesAssigned')
+    if est_bytes is None or est_bytes <= max_bytes:
+        return sql, change_end_ts, did_sql_limit, None, None, estimate, "within budget of %s bytes" % max_bytes
+
+    fraction = float(max_bytes) / est_bytes
+    fallback = t_options.get('budget_fallback', 'sample')
+
+    has_column_marker = (t_options.get('change_source') is None and marker_pair is not None
+                         and marker_pair[0] != CHANGES_MARKER)
+    if fallback == 'sample' and has_column_marker:
+        # a sample would leave the rows it missed behind the marker for good.
+        fallback = 'window'
+
+    if fallback == 'window':
+        can_window = has_column_marker and marker_pair[0] == t_order_by and max_value is not None
+        if can_window and WindowEnd(marker_pair[1], max_value, fraction) is not None:
+            # the window is a straight-line guess from the value range, so check
+            # it too and shrink it until the estimate fits.
+            for _attempt in range(BUDGET_FALLBACK_TRIES):
+                window_end = WindowEnd(marker_pair[1], max_value, fraction)
+                (sql, change_end_ts, did_sql_limit) = BuildFetchSql(table, config, cs, field_names, t_order_by, t_initial_limit,
+                                                                    t_options, marker_pair, window_end=window_end)
+                fb_bytes = ExplainSql(table, config, cs, sql).get('bytesAssigned')
+                if fb_bytes is None or fb_bytes <= max_bytes:
+                    return sql, change_end_ts, did_sql_limit, window_end, None, estimate, \
+                           "estimated %s bytes > budget %s; reading up to %s = %s" % (est_bytes, max_bytes, t_order_by, window_end)
+                fraction = fraction * max_bytes / fb_bytes
+            # endfor
+            logger.warning("%s: no %s window after the marker fits in %s bytes; skipping", table, t_order_by, max_bytes)
+            fallback = 'skip'
+        elif has_column_marker:
+            logger.warning("%s: can't work out a %s window after the marker; skipping", table, t_order_by)
+            fallback = 'skip'
+        else:
+            logger.warning("%s: window fallback needs a %s marker and max; sampling instead", table, t_order_by)
+            fallback = 'sample'
+    # endif
+
+    if fallback == 'sample' and t_options.get('change_source') is None:
+        for _attempt in range(BUDGET_FALLBACK_TRIES):
+            sample_pct = max(0.01, round(100.0 * fraction, 2))
+            (sql, change_end_ts, did_sql_limit) = BuildFetchSql(table, config, cs, field_names, t_order_by, t_initial_limit,
+                                                                t_options, marker_pair, sample_pct=sample_pct)
+            fb_bytes = ExplainSql(table, config, cs, sql).get('bytesAssigned')
+            if fb_bytes is None or fb_bytes <= max_bytes:
+                return sql, change_end_ts, did_sql_limit, None, sample_pct, estimate, \
+                       "estimated %s bytes > budget %s; sampling %s%% of blocks" % (est_bytes, max_bytes, sample_pct)
+            if sample_pct <= 0.01:
+                break
+            fraction = fraction * max_bytes / fb_bytes
+        # endfor
+        logger.warning("%s: no sample of the table fits in %s bytes; skipping", table, max_bytes)
+        fallback = 'skip'
+    # endif
+
+    return None, None, False, None, None, estimate, \
+           "estimated %s bytes > budget %s; skipping (budget_fallback: %s)" % (est_bytes, max_bytes, fallback)
+
+
+def FetchTable(table, config, sf_context, t_order_by, t_initial_limit, t_options=None):
+    logger.info("fetching ... %s", table)
+    if t_options is None:
+        t_options = {}
+
+    t_change_source = t_options.get('change_source')
+    if t_change_source is not None and t_change_source not in ('stream', 'changes'):
+        FatalError(1, "table %s: unknown change_source %s; expected stream or changes" % (table, t_change_source))
+        return
+
+    cs = sf_context.cursor()
+    warehouse = UseTableWarehouse(table, config, sf_context, cs, t_options)
 
-    #logger.debug(sql)
-    gCache.append_sql_log(table, sql)
-    gCache.save()
+    meta = {}
+    meta['snowflake_warehouse'] = warehouse
+
+    (field_names, field_types) = GetTableColumns(table, config, cs)
 
-    cs.execute(sql)
+    raw_converters = []
+    if config.get_sf_fetch_mode() == 'raw':
+        typed_columns = list(t_options.get('typed_columns', []))
+        if t_order_by is not None:
+            typed_columns.append(t_order_by)
+        raw_converters = BuildRawConverters(table, field_names, field_types, typed_columns)
+    # endif
 
-    dt = time.time() - ts
+    # build select.
+    # ok we need to see if we have fetched this table before..
+
+    # build up min/maxes in case it's useful for debugging.
+    max_value = None
+    if t_order_by is not None:
+        global_min_sql = "select min(%s) from %s"  % (t_order_by, table)
+        global_max_sql = "select max(%s) from %s"  % (t_order_by, table)
+        global_count   = "select count(*) from %s" % (table,)
+
+        ExecuteAndLog(config, cs, table, global_min_sql)
+        min_r = cs.fetchone()
+
+        ExecuteAndLog(config, cs, table, global_max_sql)
+        max_r = cs.fetchone()
+
+        ExecuteAndLog(config, cs, table, global_count)
+        count_r = cs.fetchone()
+
+        meta['min_%s' % table]   = min_r
+        meta['max_%s' % table]   = max_r
+        meta['count_%s' % table] = count_r
+
+        if max_r is not None:
+            max_value = max_r[0]
+            if raw_converters and max_value is not None:
+                fn = RawConverterForType(field_types.get(t_order_by))
+                if fn is not None:
+                    max_value = fn(max_value)
+        # endif
+    # endif
+
+    # check our history.
+    history = config.get_session_history()
+    history.load()
+
+    SF_DEBUG = os.environ.get('SF_DEBUG', False)
+    did_log_sf_debug = False
+
+    marker_pair = history.get_history(table)
+    while True:
+        try:
+            (sql, change_end_ts, did_sql_limit, window_end, sample_pct, estimate, budget_note) = \
+                PlanFetch(table, config, cs, field_names, t_order_by, t_initial_limit, t_options, marker_pair, max_value)
+            if budget_note is not None:
+                logger.info("%s: %s", table, budget_note)
+                meta['snowflake_budget'] = budget_note
+            if sql is None:
+                cs.close()
+                return
+
+            #logger.debug(sql)
+            history.save()
+
+            t_statement_timeout = t_options.get('statement_timeout')
+            if t_statement_timeout is not None:
+                ExecuteAndLog(config, cs, table, "ALTER SESSION SET STATEMENT_TIMEOUT_IN_SECONDS = %d" % int(t_statement_timeout))
+            try:
+                dt = ExecuteAndLog(config, cs, table, sql)
+            finally:
+                if t_statement_timeout is not None:
+                    ExecuteAndLog(config, cs, table, "ALTER SESSION UNSET STATEMENT_TIMEOUT_IN_SECONDS")
+            break
+        except Exception as e:
+            if t_change_source is None or marker_pair is None or marker_pair[0] != CHANGES_MARKER:
+                raise
+            if not ChangesMarkerExpired(e):
+                # a timeout, a suspended warehouse, a network error... the
+                # marker is still good, so leave it for the next run.
+                raise
+            # Our marker is older than the table's change tracking retention
+            # (e.g., after an outage); it would fail the same way on every
+            # run, so start over as if we'd never seen the table.
+            logger.error("%s: reading changes since %s failed: %s; starting over as on a first run",
+                         table, marker_pair[1], e)
+            marker_pair = None
+        # endtry
+    # endwhile
 
     meta['snowflake_sql_query'] = sql
     meta['snowflake_sql_processing_time'] = dt
@@ -515,6 +1262,10 @@ def FetchTable(table, config, sf_context, t_order_by, t_initial_limit):
 
     print("\n\n\n\n")
 
+    order_by_index = None
+    if t_order_by in field_names:
+        order_by_index = field_names.index(t_order_by)
+
     # we want to set a timeshift.
     last_timeshift = 0
     dc = None # Delay opening the connection til we are ready. config.connect_controller(table, timeshift=0)
@@ -527,15 +1278,19 @@ def FetchTable(table, config, sf_context, t_order_by, t_initial_limit):
         for rr in r:
             total_r_count += 1
             timeshift_r_count += 1
-            df_entry = {}
-            this_timeshift = None
-            for i in range(0, len(rr)):
-                df_entry[field_names[i]] = rr[i]
-
-                if field_names[i] == t_order_by:
-                    this_timeshift = rr[i]
+            if raw_converters:
+                rr = list(rr)
+                for (i, fn) in raw_converters:
+                    if rr[i] is not None:
+                        rr[i] = fn(rr[i])
+                # endfor
             # endif
 
+            df_entry = dict(zip(field_names, rr))
+            this_timeshift = None
+            if order_by_index is not None:
+                this_timeshift = rr[order_by_index]
+
             if this_timeshift is not None:
                 dt_now = datetime.now(timezone.utc)
                 dt_delta = dt_now - this_timeshift
@@ -561,7 +1316,9 @@ def FetchTable(table, config, sf_context, t_order_by, t_initial_limit):
                 dc = config.connect_controller(table, timeshift=0)
             #print(df_entry)
             dc.queue_record(df_entry)
-            cache_marker = this_timeshift
+            if cache_marker is None:
+                # rows come newest first, so the first value is the high-water mark.
+                cache_marker = this_timeshift
 
             # just for debugging
             if SF_DEBUG:
@@ -572,15 +1329,26 @@ def FetchTable(table, config, sf_context, t_order_by, t_initial_limit):
                     break
 
     # endwhile
-    if total_r_count > 0:
+    if change_end_ts is not None:
+        # move forward even if nothing changed.
+        history.add_history(table, CHANGES_MARKER, change_end_ts)
+        history.save()
+    elif window_end is not None:
+        # we read the whole window, so the next run starts after it even if it was empty.
+        history.add_history(table, t_order_by, window_end)
+        history.save()
+    elif sample_pct is not None:
+        # a sample skips rows, so moving the marker past them would lose them.
+        pass
+    elif total_r_count > 0:
         if cache_marker is None:
             if t_order_by is not None:
                 logger.error("ERROR: we specified an order by constraint for caching that is missing from the table schema.")
                 sys.exit(2)
         else:
             # OK, save it off...
-            gCache.add_history(table, t_order_by, cache_marker)
-            gCache.save()
+            history.add_history(table, t_order_by, cache_marker)
+            history.save()
         # endif
     # endif
 
@@ -602,10 +1370,524 @@ def FetchTable(table, config, sf_context, t_order_by, t_initial_limit):
     print("-------")
     return
 
+def ProfileDir(config):
+    # profiles go next to the session history file.
+    cache_dir = os.path.dirname(os.path.abspath(config.get_sf_local_cache_file()))
+    out_dir = os.path.join(cache_dir, "profiles")
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+    return out_dir
+
+
+def _write_cpu_profile(prof, base_path, table, top_n):
+    prof.dump_stats(base_path + ".prof")
+    with open(base_path + ".cpu.txt", "w") as f:
+        f.write("CPU profile for %s\n\n" % table)
+        st = pstats.Stats(prof, stream=f)
+        st.sort_stats('cumulative').print_stats(top_n)
+        st.sort_stats('tottime').print_stats(top_n)
+    # endwith
+
+    # a few lines in the log so a slow run says where it went without opening files.
+    st = pstats.Stats(prof)
+    st.sort_stats('tottime')
+    logger.info("cpu hot spots for %s (full profile in %s.prof):", table, base_path)
+    for func in st.fcn_list[:5]:
+        (_cc, ncalls, tottime, cumtime, _callers) = st.stats[func]
+        logger.info("  %8.3fs self %8.3fs cum %9d calls  %s:%d(%s)", tottime, cumtime, ncalls, *func)
+    return
+
+
+def _write_mem_profile(snapshot_before, snapshot_after, peak, base_path, table, top_n):
+    # leave out the profilers' own bookkeeping when both are on.
+    _filters = [tracemalloc.Filter(False, tracemalloc.__file__),
+                tracemalloc.Filter(False, cProfile.__file__),
+                tracemalloc.Filter(False, pstats.__file__),
+                tracemalloc.Filter(False, "<frozen importlib._bootstrap>")]
+    snapshot_before = snapshot_before.filter_traces(_filters)
+    snapshot_after = snapshot_after.filter_traces(_filters)
+
+    with open(base_path + ".mem.txt", "w") as f:
+        f.write("Memory profile for %s\n\n" % table)
+        f.write("peak traced memory: %d bytes\n\n" % peak)
+        f.write("Largest allocations still held at the end of the fetch:\n")
+        for stat in snapshot_after.statistics('lineno')[:top_n]:
+            f.write("  %s\n" % stat)
+        f.write("\nLargest changes over the fetch:\n")
+        for stat in snapshot_after.compare_to(snapshot_before, 'lineno')[:top_n]:
+            f.write("  %s\n" % stat)
+    # endwith
+
+    logger.info("memory for %s: peak %.1f MiB (details in %s.mem.txt)", table, peak / 1048576.0, base_path)
+    return
+
+
+def RunProfiled(config, table, profile_cpu, profile_mem, top_n, fn, *args):
+    # Runs fn(*args), optionally under cProfile and/or tracemalloc, and writes
+    # <table>-<time>.prof/.cpu.txt/.mem.txt into the profiles directory.
+    if not profile_cpu and not profile_mem:
+        return fn(*args)
+
+    safe_table = "".join([ch if ch.isalnum() or ch in "._-" else "_" for ch in table])
+    base_path = os.path.join(ProfileDir(config), "%s-%s" % (safe_table, datetime.now().strftime("%Y%m%d-%H%M%S")))
+
+    snapshot_before = None
+    started_tracemalloc = False
+    if profile_mem:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start(10)
+            started_tracemalloc = True
+        tracemalloc.reset_peak()
+        snapshot_before = tracemalloc.take_snapshot()
+    # endif
+
+    prof = None
+    if profile_cpu:
+        prof = cProfile.Profile()
+        prof.enable()
+
+    try:
+        return fn(*args)
+    finally:
+        if prof is not None:
+            prof.disable()
+
+        if profile_mem:
+            # before the CPU profile is written out, so its dump isn't counted.
+            snapshot_after = tracemalloc.take_snapshot()
+            (_current, peak) = tracemalloc.get_traced_memory()
+            if started_tracemalloc:
+                tracemalloc.stop()
+        # endif
+
+        if prof is not None:
+            _write_cpu_profile(prof, base_path, table, top_n)
+        if profile_mem:
+            _write_mem_profile(snapshot_before, snapshot_after, peak, base_path, table, top_n)
+    # endtry
+
+
 def CloseSnowflake(sf_context):
     sf_context.close()
     return
 
+def ShardKey(config, table_name):
+    # tables are identified by pipeline + database + table so two yaml files
+    # that watch the same table under different pipelines, or same-named tables
+    # in different databases, don't fight over it or share its marker.
+    return "%s/%s/%s" % (config.get_pipeline_name(), config.get_sf_database(), table_name)
+
+
+def _rendezvous_score(key, bucket):
+    h = hashlib.md5(("%s|%s" % (bucket, key)).encode('utf-8')).hexdigest()
+    return int(h[:16], 16)
+
+
+def RendezvousOwner(key, buckets):
+    # Highest-random-weight hashing: adding or removing a bucket only moves the
+    # keys that bucket wins or loses, so the rest of the assignment is stable.
+    best = None
+    best_score = -1
+    for b in buckets:
+        score = _rendezvous_score(key, b)
+        if score > best_score:
+            best = b
+            best_score = score
+    # endfor
+    return best
+
+
+def ParseShard(shard_str):
+    try:
+        (i, n) = shard_str.split("/")
+        (i, n) = (int(i), int(n))
+    except ValueError:
+        FatalError(1, "--shard takes i/N, e.g., 0/3; got %s" % shard_str)
+        return None
+
+    if n < 1 or i < 0 or i >= n:
+        FatalError(1, "--shard %s: need 0 <= i < N" % shard_str)
+        return None
+
+    return (i, n)
+
+
+class LeaseStore:
+    """Time-limited claims on tables shared between connector hosts.
+
+    Each host registers itself as a member and claims only the tables that
+    rendezvous hashing assigns to it among the live members. Leases are kept
+    (and renewed by a heartbeat thread for the length of the run) rather than
+    released, so a table stays with one host from run to run; if that host
+    stops renewing, its membership and leases expire after lease_ttl seconds
+    and the surviving hosts pick its tables up.
+
+    When membership changes and a table hashes to another live host, the
+    current holder reads it once more and then releases the lease (see
+    finished()), so the new owner can claim it on its next run without the
+    table going unread in between.
+
+    Each table's high-water mark is kept on its lease row: it is read in the
+    same transaction that claims the lease and only written while the lease
+    is still ours, so the next host picks up exactly where the last one
+    stopped.
+    """
+
+    MEMBER_PREFIX = "$host:"
+
+    def __init__(self, owner, ttl):
+        self.owner = owner
+        self.ttl = ttl
+        self.held = set()
+        self.handing_over = set()
+        self._owned = set()
+        self._markers = {} # key -> (field_name, value) as of the claim or our last save
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    # subclasses implement these. _try_claim records the key's marker in
+    # self._markers when it succeeds.
+    def _try_claim(self, key):
+        raise NotImplementedError()
+
+    def _load_marker(self, key):
+        raise NotImplementedError()
+
+    def _save_marker(self, key, field_name, value):
+        raise NotImplementedError()
+
+    def _release(self, key):
+        raise NotImplementedError()
+
+    def _owned_keys(self):
+        raise NotImplementedError()
+
+    def _renew(self, key):
+        raise NotImplementedError()
+
+    def _live_owners(self, prefix):
+        raise NotImplementedError()
+
+    def join(self):
+        # an overlapping run on the same host shares the owner name, so this always succeeds.
+        member_key = self.MEMBER_PREFIX + self.owner
+        self._try_claim(member_key)
+        with self._lock:
+            self.held.add(member_key)
+        return
+
+    def live_members(self):
+        # also note which leases we already hold, for claim() to hand over.
+        self._owned = set(self._owned_keys())
+
+        members = []
+        for key in self._live_owners(self.MEMBER_PREFIX):
+            members.append(key[len(self.MEMBER_PREFIX):])
+        if self.owner not in members:
+            members.append(self.owner)
+        return sorted(members)
+
+    def claim(self, key, members):
+        preferred = RendezvousOwner(key, members)
+        if preferred != self.owner:
+            if key not in self._owned:
+                return False
+            # we held it before the membership changed; read it this time and
+            # let it go afterwards.
+            marker = self._load_marker(key)
+            with self._lock:
+                self._markers[key] = marker
+                self.held.add(key)
+                self.handing_over.add(key)
+            return True
+        # endif
+        if not self._try_claim(key):
+            # the previous owner's lease hasn't expired yet; we'll get it next time.
+            return False
+        with self._lock:
+            self.held.add(key)
+        return True
+
+    def get_marker(self, key):
+        with self._lock:
+            return self._markers.get(key)
+
+    def save_marker(self, key, field_name, value):
+        if not self._save_marker(key, field_name, value):
+            logger.warning("lost lease on %s; not saving its marker", key)
+            return False
+        with self._lock:
+            self._markers[key] = (field_name, value)
+        return True
+
+    def finished(self, key):
+        # called after a claimed table is fetched.
+        with self._lock:
+            if key not in self.handing_over:
+                return
+            self.handing_over.discard(key)
+            self.held.discard(key)
+        # endwith
+        self._release(key)
+        logger.info("released lease on %s to its new owner", key)
+        return
+
+    def renew_all(self):
+        with self._lock:
+            keys = list(self.held)
+        for key in keys:
+            if not self._renew(key):
+                logger.warning("lost lease on %s", key)
+                with self._lock:
+                    self.held.discard(key)
+        # endfor
+        return
+
+    def _heartbeat_loop(self):
+        while not self._stop.wait(max(1, self.ttl / 3)):
+            try:
+                self.renew_all()
+            except:
+                traceback.print_exc()
+        # endwhile
+        return
+
+    def start_heartbeat(self):
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._heartbeat_loop, name="lease-heartbeat", daemon=True)
+        self._heartbeat.start()
+        return
+
+    def stop_heartbeat(self):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+            self._heartbeat = None
+        # one last renewal so the lease runs a full ttl from the end of the run.
+        self.renew_all()
+        return
+
+
+class SQLiteLeaseStore(LeaseStore):
+    """Lease table in a SQLite file; for tests or hosts sharing a filesystem."""
+
+    def __init__(self, path, owner, ttl):
+        LeaseStore.__init__(self, owner, ttl)
+        self.path = path
+        c = self._connect()
+        c.execute("create table if not exists leases (object_name text primary key, owner text, expires real, "
+                  "field_name text, field_value blob)")
+        _columns = [row[1] for row in c.execute("pragma table_info(leases)")]
+        for col_name, col_type in [("field_name", "text"), ("field_value", "blob")]:
+            if col_name not in _columns:
+                c.execute("alter table leases add column %s %s" % (col_name, col_type))
+        # endfor
+        c.close()
+
+    def _connect(self):
+        return sqlite3.connect(self.path, timeout=30, isolation_level=None)
+
+    def _try_claim(self, key):
+        now = time.time()
+        c = self._connect()
+        try:
+            c.execute("begin immediate")
+            row = c.execute("select owner, expires, field_name, field_value from leases where object_name = ?",
+                            (key,)).fetchone()
+            if row is not None and row[0] != self.owner and row[1] >= now:
+                c.execute("rollback")
+                return False
+            if row is None:
+                c.execute("insert into leases (object_name, owner, expires) values (?,?,?)",
+                          (key, self.owner, now + self.ttl))
+            else:
+                c.execute("update leases set owner = ?, expires = ? where object_name = ?",
+                          (self.owner, now + self.ttl, key))
+            c.execute("commit")
+        finally:
+            c.close()
+
+        marker = None
+        if row is not None and row[2] is not None:
+            marker = (row[2], pickle.loads(row[3]))
+        with self._lock:
+            self._markers[key] = marker
+        return True
+
+    def _load_marker(self, key):
+        c = self._connect()
+        row = c.execute("select field_name, field_value from leases where object_name = ?", (key,)).fetchone()
+        c.close()
+        if row is None or row[0] is None:
+            return None
+        return (row[0], pickle.loads(row[1]))
+
+    def _save_marker(self, key, field_name, value):
+        c = self._connect()
+        r = c.execute("update leases set field_name = ?, field_value = ? where object_name = ? and owner = ?",
+                      (field_name, pickle.dumps(value), key, self.owner))
+        ok = r.rowcount == 1
+        c.close()
+        return ok
+
+    def _release(self, key):
+        # keep the row (and its marker) for the next owner.
+        c = self._connect()
+        c.execute("update leases set owner = null, expires = 0 where object_name = ? and owner = ?", (key, self.owner))
+        c.close()
+        return
+
+    def _owned_keys(self):
+        c = self._connect()
+        r = c.execute("select object_name from leases where owner = ?", (self.owner,))
+        keys = [row[0] for row in r]
+        c.close()
+        return keys
+
+    def _renew(self, key):
+        c = self._connect()
+        r = c.execute("update leases set expires = ? where object_name = ? and owner = ?",
+                      (time.time() + self.ttl, key, self.owner))
+        ok = r.rowcount == 1
+        c.close()
+        return ok
+
+    def _live_owners(self, prefix):
+        c = self._connect()
+        r = c.execute("select object_name from leases where object_name like ? and expires >= ?",
+                      (prefix + "%", time.time()))
+        keys = [row[0] for row in r]
+        c.close()
+        return keys
+
+
+class SnowflakeLeaseStore(LeaseStore):
+    """Lease table in Snowflake, using the server clock for expiry."""
+
+    def __init__(self, table_name, owner, ttl, config, sf_context):
+        LeaseStore.__init__(self, owner, ttl)
+        self.table_name = table_name
+        self.config = config
+        self.sf_context = sf_context
+        cs = self._cursor()
+        UseWarehouseDatabaseFromConfig(config, cs, "(leases)")
+        ExecuteAndLog(config, cs, "(leases)",
+                      "create table if not exists %s (object_name string, owner string, expires timestamp_ltz, "
+                      "field_name string, field_value string)" % table_name)
+        for col_name in ["field_name", "field_value"]:
+            ExecuteAndLog(config, cs, "(leases)", "alter table %s add column if not exists %s string" % (table_name, col_name))
+        cs.close()
+
+    def _cursor(self):
+        # The heartbeat thread gets its own cursors; the connection itself is
+        # shared. No USE here: that would switch the warehouse out from under
+        # the fetch running on the main thread.
+        return self.sf_context.cursor()
+
+    def _try_claim(self, key):
+        params = { 'key': key, 'owner': self.owner, 'ttl': int(self.ttl) }
+        cs = self._cursor()
+        ExecuteAndLog(self.config, cs, "(leases)",
+                      "merge into %s l using (select %%(key)s as object_name) s on l.object_name = s.object_name "
+                      "when matched and (l.expires < current_timestamp() or l.owner = %%(owner)s) then "
+                      "update set owner = %%(owner)s, expires = dateadd(second, %%(ttl)s, current_timestamp()) "
+                      "when not matched then insert (object_name, owner, expires) "
+                      "values (s.object_name, %%(owner)s, dateadd(second, %%(ttl)s, current_timestamp()))"
+                      % self.table_name, params)
+        ExecuteAndLog(self.config, cs, "(leases)",
+                      "select owner, field_name, field_value from %s where object_name = %%(key)s" % self.table_name, params)
+        row = cs.fetchone()
+        cs.close()
+        if row is None or row[0] != self.owner:
+            return False
+        with self._lock:
+            self._markers[key] = self._decode_marker(row[1], row[2])
+        return True
+
+    def _decode_marker(self, field_name, field_value):
+        # values are pickled like the session history's, then base64'd to fit a string column.
+        if field_name is None:
+            return None
+        return (field_name, pickle.loads(base64.b64decode(field_value)))
+
+    def _load_marker(self, key):
+        cs = self._cursor()
+        ExecuteAndLog(self.config, cs, "(leases)",
+                      "select field_name, field_value from %s where object_name = %%(key)s" % self.table_name, { 'key': key })
+        row = cs.fetchone()
+        cs.close()
+        if row is None:
+            return None
+        return self._decode_marker(row[0], row[1])
+
+    def _save_marker(self, key, field_name, value):
+        params = { 'key': key, 'owner': self.owner, 'field_name': field_name,
+                   'field_value': base64.b64encode(pickle.dumps(value)).decode('ascii') }
+        cs = self._cursor()
+        ExecuteAndLog(self.config, cs, "(leases)",
+                      "update %s set field_name = %%(field_name)s, field_value = %%(field_value)s "
+                      "where object_name = %%(key)s and owner = %%(owner)s" % self.table_name, params)
+        ok = cs.rowcount == 1
+        cs.close()
+        return ok
+
+    def _renew(self, key):
+        params = { 'key': key, 'owner': self.owner, 'ttl': int(self.ttl) }
+        cs = self._cursor()
+        ExecuteAndLog(self.config, cs, "(leases)",
+                      "update %s set expires = dateadd(second, %%(ttl)s, current_timestamp()) "
+                      "where object_name = %%(key)s and owner = %%(owner)s" % self.table_name, params)
+        ok = cs.rowcount == 1
+        cs.close()
+        return ok
+
+    def _release(self, key):
+        # keep the row (and its marker) for the next owner.
+        cs = self._cursor()
+        ExecuteAndLog(self.config, cs, "(leases)",
+                      "update %s set owner = null, expires = to_timestamp_ltz(0) "
+                      "where object_name = %%(key)s and owner = %%(owner)s" % self.table_name,
+                      { 'key': key, 'owner': self.owner })
+        cs.close()
+        return
+
+    def _owned_keys(self):
+        cs = self._cursor()
+        ExecuteAndLog(self.config, cs, "(leases)",
+                      "select object_name from %s where owner = %%(owner)s" % self.table_name, { 'owner': self.owner })
+        keys = [row[0] for row in cs.fetchall()]
+        cs.close()
+        return keys
+
+    def _live_owners(self, prefix):
+        cs = self._cursor()
+        ExecuteAndLog(self.config, cs, "(leases)",
+                      "select object_name from %s where startswith(object_name, %%(prefix)s) "
+                      "and expires >= current_timestamp()" % self.table_name, { 'prefix': prefix })
+        keys = [row[0] for row in cs.fetchall()]
+        cs.close()
+        return keys
+
+
+def OpenLeaseStore(config, sf_context, owner):
+    store = config.get_lease_store()
+    if store is None:
+        FatalError(1, "--lease needs lease_store in the configuration, e.g., sqlite:/shared/leases.db "
+                      "or snowflake:DB.SCHEMA.DC_LEASES")
+        return None
+
+    ttl = config.get_lease_ttl()
+    (kind, _, location) = store.partition(":")
+    if kind == "sqlite":
+        return SQLiteLeaseStore(location, owner, ttl)
+    elif kind == "snowflake":
+        return SnowflakeLeaseStore(location, owner, ttl, config, sf_context)
+
+    FatalError(1, "unknown lease_store %s; expected sqlite:<path> or snowflake:<table>" % store)
+    return None
+
+
 def do_init(filename):
     print("Initialize new file")
     config = Config()
@@ -624,15 +1906,14 @@ def _check_perms(table_name, config, sf_context):
     #select count(*) from table_name
     #select * from table_name limit 1;
     cs = sf_context.cursor()
-    UseWarehouseDatabaseFromConfig(config, cs)
+    UseWarehouseDatabaseFromConfig(config, cs, table_name)
     prefix = ""
     if os.environ.get("SF_PREFIX") is not None:
         prefix = os.environ.get("SF_PREFIX")
     sql = "select * from %s%s limit 1" % (prefix, table_name)
 
-    gCache.append_sql_log(table_name, sql)
     try:
-        cs.execute(sql)
+        ExecuteAndLog(config, cs, table_name, sql)
         a_row = cs.fetchone()
         return True, "got a row back without errors"
     except:
@@ -658,7 +1939,6 @@ def do_discover(filename, table_name, perms_check):
     print("discover with config from file %s" % filename)
     config = Config()
     config.load(filename)
-    gCache.set_config(config)
     sf_context = ConnectToSnowflake(config)
 
     if table_name:
@@ -728,7 +2008,6 @@ def do_test(filename):
     print("test with config from file %s" % filename)
     config = Config()
     config.load(filename)
-    gCache.set_config(config)
 
     # get the table list...
     table_list = config.get_sf_table_list()
@@ -742,47 +2021,267 @@ def do_test(filename):
 
     return
 
-def do_run(filename, table_name, nocache_mode):
-    logger.info("run with config from file %s" % filename)
-    config = Config()
-    config.load(filename)
+def ExpandConfigPaths(paths):
+    # --run takes yaml files and/or directories of them.
+    filenames = []
+    for path in paths:
+        if os.path.isdir(path):
+            found = sorted(glob.glob(os.path.join(path, "*.yaml")) + glob.glob(os.path.join(path, "*.yml")))
+            if not found:
+                FatalError(1, "no .yaml or .yml files in %s" % path)
+                return []
+            filenames.extend(found)
+        else:
+            filenames.append(path)
+    # endfor
+    return filenames
+
+
+def ControllerConnectionIsOk(config, checked):
+    # configs talking to the same Validator as the same user only test it once.
+    cc = config.get_controller()
+    key = (cc.get('protocol', 'https'), cc.get('host'), cc.get('port'), cc.get('api_user'))
+    if key not in checked:
+        checked[key] = config.test_controller_connection_is_ok()
+    return checked[key]
+
+
+def RunTableJob(pool, leases, config, t_name, t_order_by, t_initial_limit, t, profile_cpu, profile_mem, profile_top):
+    sf_context = pool.acquire(config)
+    try:
+        RunProfiled(config, t_name, profile_cpu, profile_mem, profile_top,
+                    FetchTable, t_name, config, sf_context, t_order_by, t_initial_limit, t)
+    finally:
+        pool.release(config, sf_context)
 
-    is_OK = config.test_controller_connection_is_ok()
-    if not is_OK:
-        FatalError(2, "Couldn't connect to Data Culpa Validator for test connection; aborting")
+    if leases is not None:
+        leases.finished(ShardKey(config, t_name))
+    return
+
+
+def do_run(filenames, table_name, nocache_mode, shard=None, lease_owner=None,
+           profile_cpu=False, profile_mem=False, profile_top=20, concurrency=1):
+    if (profile_cpu or profile_mem) and concurrency > 1:
+        # tracemalloc is process-wide and only one cProfile can be active at a
+        # time on newer Pythons, so overlapping tables would break each other.
+        FatalError(1, "--profile-cpu/--profile-mem need --concurrency 1")
         return
 
-    gCache.set_config(config)
-    gCache.set_write_enabled(not nocache_mode)
+    configs = []
+    controller_checks = {}
+    for filename in ExpandConfigPaths(filenames):
+        logger.info("run with config from file %s" % filename)
+        config = Config()
+        config.load(filename)
+
+        is_OK = ControllerConnectionIsOk(config, controller_checks)
+        if not is_OK:
+            FatalError(2, "%s: Couldn't connect to Data Culpa Validator for test connection; aborting" % filename)
+            return
+
+        config.get_session_history().set_write_enabled(not nocache_mode)
+
+        # get the table list...
+        if not config.get_sf_table_list():
+            FatalError(1, "%s: no tables listed to triage!" % filename)
+            return
+
+        configs.append(config)
+    # endfor
+
+    pool = SessionPool()
+    lease_stores = {} # lease_store name -> (LeaseStore, live members)
+
+    jobs = []
+    for config in configs:
+        leases = None
+        lease_members = None
+        if lease_owner is not None:
+            store_name = config.get_lease_store()
+            if store_name not in lease_stores:
+                sf_context = None
+                if store_name is not None and store_name.startswith("snowflake:"):
+                    # the lease store keeps a session of its own for the heartbeat.
+                    sf_context = pool.acquire(config)
+                leases = OpenLeaseStore(config, sf_context, lease_owner)
+                leases.join()
+                leases.start_heartbeat()
+                lease_members = leases.live_members()
+                logger.info("lease mode: %s of %d live hosts %s", lease_owner, len(lease_members), lease_members)
+                lease_stores[store_name] = (leases, lease_members)
+            # endif
+            (leases, lease_members) = lease_stores[store_name]
+            config.get_session_history().set_lease_store(leases)
+        # endif
+
+        for t in config.get_sf_table_list():
+            t_name          = t.get('table')
+
+            if shard is not None:
+                (shard_index, shard_count) = shard
+                if RendezvousOwner(ShardKey(config, t_name), range(shard_count)) != shard_index:
+                    continue
+            # endif
+            t_order_by      = t.get('desc_order_by')
+            t_initial_limit = t.get('initial_limit')
+            t_timeshift     = t.get('timeshift', False) # True/False
+
+            if t_timeshift != True:
+                t_timeshift = False
+
+            # without a limit or a scan budget, a table we haven't seen yet would be read in full.
+            if t_initial_limit is None and TableMaxBytesScanned(config, t) is None:
+                logger.warning("%s has no initial_limit or max_bytes_scanned; limiting the first read to %d rows",
+                               t_name, DEFAULT_INITIAL_LIMIT)
+                t_initial_limit = DEFAULT_INITIAL_LIMIT
+
+            if table_name is not None and t_name.lower() != table_name.lower():
+                continue
+
+            if leases is not None:
+                if not leases.claim(ShardKey(config, t_name), lease_members):
+                    logger.info("skipping %s; leased to another host", t_name)
+                    continue
+            # endif
+
+            jobs.append((leases, config, t_name, t_order_by, t_initial_limit, t))
+        # endfor
+    # endfor
+
+    # one concurrency budget for every table of every config.
+    try:
+        if concurrency <= 1:
+            for (leases, config, t_name, t_order_by, t_initial_limit, t) in jobs:
+                RunTableJob(pool, leases, config, t_name, t_order_by, t_initial_limit, t,
+                            profile_cpu, profile_mem, profile_top)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+                futures = []
+                for (leases, config, t_name, t_order_by, t_initial_limit, t) in jobs:
+                    futures.append(executor.submit(RunTableJob, pool, leases, config, t_name, t_order_by, t_initial_limit, t,
+                                                   profile_cpu, profile_mem, profile_top))
+                for f in futures:
+                    f.result()
+            # endwith
+        # endif
+    finally:
+        for (leases, _lease_members) in lease_stores.values():
+            leases.stop_heartbeat()
+        pool.close_all()
+    # endtry
+
+    for config in configs:
+        config.get_session_history().prune_sql_log()
+
+    return
+
+def do_plan(filename, table_name):
+    print("plan with config from file %s" % filename)
+    config = Config()
+    config.load(filename)
+    history = config.get_session_history()
+    history.set_write_enabled(False)
 
-    # get the table list...
     table_list = config.get_sf_table_list()
     if not table_list:
         FatalError(1, "no tables listed to triage!")
         return
 
     sf_context = ConnectToSnowflake(config)
+    history.load()
 
     for t in table_list:
         t_name          = t.get('table')
         t_order_by      = t.get('desc_order_by')
         t_initial_limit = t.get('initial_limit')
-        t_timeshift     = t.get('timeshift', False) # True/False
-        
-        if t_timeshift != True:
-            t_timeshift = False
 
-        # little safeguard while we test
-        if t_initial_limit is None:
-            t_initial_limit = 1000
+        if table_name is not None and t_name.lower() != table_name.lower():
+            continue
 
-        if table_name is not None:
-            if t_name.lower() == table_name.lower():
-                FetchTable(t_name, config, sf_context, t_order_by, t_initial_limit)
-        else:
-            # normal operation
-            FetchTable(t_name, config, sf_context, t_order_by, t_initial_limit)
+        if t_initial_limit is None and TableMaxBytesScanned(config, t) is None:
+            t_initial_limit = DEFAULT_INITIAL_LIMIT
+
+        cs = sf_context.cursor()
+        warehouse = UseTableWarehouse(t_name, config, sf_context, cs, t)
+
+        (field_names, field_types) = GetTableColumns(t_name, config, cs)
+
+        max_value = None
+        if t_order_by is not None:
+            ExecuteAndLog(config, cs, t_name, "select max(%s) from %s" % (t_order_by, t_name))
+            max_value = cs.fetchone()[0]
+            if max_value is not None and config.get_sf_fetch_mode() == 'raw':
+                fn = RawConverterForType(field_types.get(t_order_by))
+                if fn is not None:
+                    max_value = fn(max_value)
         # endif
+
+        marker_pair = history.get_history(t_name)
+        (sql, _change_end_ts, _did_sql_limit, _window_end, _sample_pct, estimate, budget_note) = \
+            PlanFetch(t_name, config, cs, field_names, t_order_by, t_initial_limit, t, marker_pair, max_value)
+
+        if estimate is None and sql is not None:
+            estimate = ExplainSql(t_name, config, cs, sql)
+
+        print()
+        print("Table %s:" % t_name)
+        print("  warehouse:  %s" % warehouse)
+        print("  marker:     %s" % (marker_pair,))
+        if estimate:
+            print("  partitions: %s of %s" % (estimate.get('partitionsAssigned'), estimate.get('partitionsTotal')))
+            print("  bytes:      %s" % estimate.get('bytesAssigned'))
+        if budget_note is not None:
+            print("  budget:     %s" % budget_note)
+        if t.get('statement_timeout') is not None:
+            print("  timeout:    %ss" % t.get('statement_timeout'))
+        if sql is not None:
+            print("  sql:        %s" % sql)
+        else:
+            print("  sql:        (skipped)")
+
+        cs.close()
+    # endfor
+
+    return
+
+def do_history(filename, table_name, top_n=10):
+    print("sql history with config from file %s" % filename)
+    config = Config()
+    config.load(filename)
+
+    cache_path = config.get_sf_local_cache_file()
+    if not os.path.exists(cache_path):
+        FatalError(1, "no session history cache at %s" % cache_path)
+        return
+
+    (slowest, frequent) = config.get_session_history().get_sql_log_summary(table_name, top_n)
+
+    if table_name is None:
+        print("(top %d per table)" % top_n)
+
+    print()
+    print("Slowest statements:")
+    last_obj = None
+    for (obj_name, duration, row_count, query_id, ts, sql) in slowest:
+        if obj_name != last_obj:
+            print("  %s:" % obj_name)
+            last_obj = obj_name
+        print("  %8.3fs %10s rows  %s  %s" % (duration, row_count, ts, query_id))
+        print("            %s" % sql)
+    # endfor
+
+    print()
+    print("Most frequent statements:")
+    last_obj = None
+    for (obj_name, count, avg_duration, max_duration, template) in frequent:
+        if obj_name != last_obj:
+            print("  %s:" % obj_name)
+            last_obj = obj_name
+        if avg_duration is None:
+            print("  %8d x" % count)
+        else:
+            print("  %8d x  avg %8.3fs  max %8.3fs" % (count, avg_duration, max_duration))
+        print("            %s" % template)
     # endfor
 
     return
@@ -795,14 +2294,28 @@ def main():
     ap.add_argument("--init", help="Init a yaml config file to fill in.")
     ap.add_argument("--discover", help="Run the specified configuration to discover available databases/tables in Snowflake")
     ap.add_argument("--test", help="Test the configuration specified.")
-    ap.add_argument("--run", help="Normal operation: run the pipeline")
+    ap.add_argument("--run", help="Normal operation: run the pipeline for one or more config files or directories of them",
+                    nargs='+')
+    ap.add_argument("--plan", help="Print the SQL each table would run and the bytes it would scan, without fetching")
+    ap.add_argument("--history", help="Show the slowest and most frequent SQL statements from the session history cache")
 
     ap.add_argument("--nocache", help="Do not move cache forward (for testing)", action='store_true')
+    ap.add_argument("--shard", help="Run only the i-th of N shards of the table_list, e.g., 0/3")
+    ap.add_argument("--lease", help="Claim tables through the lease_store so several hosts can share one config",
+                    action='store_true')
+    ap.add_argument("--concurrency", help="Number of tables to fetch at once across all --run configs (default 1)",
+                    type=int, default=1)
+    ap.add_argument("--lease-owner", help="Name this host uses in the lease_store (default: hostname)")
 #    subparsers = ap.add_subparsers(help="aroo?")
 
     # FIXME: implement discover as a subcommand.
 #    ap_discover = subparsers.add_parser("--discover")
     ap.add_argument("--table", help="Operate on the specified table name")
+    ap.add_argument("--profile-cpu", help="Write a cProfile profile of each table's fetch next to the cache file",
+                    action='store_true')
+    ap.add_argument("--profile-mem", help="Write a tracemalloc memory profile of each table's fetch next to the cache file",
+                    action='store_true')
+    ap.add_argument("--profile-top", help="Number of entries in the profile summaries (default 20)", type=int, default=20)
 #    ap.add_argument("--perms", help="Check permissions")
 
     args = ap.parse_args()
@@ -811,6 +2324,10 @@ def main():
     if args.init:
         do_init(args.init)
         return
+    elif args.history:
+        # only reads the local cache file; no secrets needed.
+        do_history(args.history, args.table)
+        return
     else:
         env_path = ".env"
         if args.env:
@@ -829,9 +2346,20 @@ def main():
             dotenv.load_dotenv(env_path)
             do_test(args.test)
             return
+        elif args.plan:
+            dotenv.load_dotenv(env_path)
+            do_plan(args.plan, args.table)
+            return
         elif args.run:
             dotenv.load_dotenv(env_path)
-            do_run(args.run, args.table, args.nocache)
+            shard = None
+            if args.shard:
+                shard = ParseShard(args.shard)
+            lease_owner = None
+            if args.lease:
+                lease_owner = args.lease_owner or socket.gethostname()
+            do_run(args.run, args.table, args.nocache, shard, lease_owner,
+                   args.profile_cpu, args.profile_mem, args.profile_top, args.concurrency)
             return
         # endif
     # endif
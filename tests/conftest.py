@@ -0,0 +1,98 @@
+import os
+import sys
+
+import pytest
+
+# sfdatalake is a script at the top of the repo, not a package.
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+for _mod in ['snowflake.connector', 'dataculpa', 'dotenv', 'yaml']:
+    pytest.importorskip(_mod)
+
+
+@pytest.fixture
+def config(tmp_path):
+    import sfdatalake
+    # SHOW results are shared process-wide; don't let them leak between tests.
+    sfdatalake.gMetadataCache.clear()
+    c = sfdatalake.Config()
+    c._d['configuration']['session_history_cache'] = str(tmp_path / "session_history_cache.db")
+    c._d['configuration']['database'] = 'DB'
+    c._d['dataculpa_pipeline']['name'] = 'pipeline'
+    return c
+
+
+class FakeCursor:
+    """Just enough of a snowflake cursor for FetchTable: answers from a
+    list of (sql prefix, description, rows) and records what ran."""
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.description = None
+        self.rowcount = 0
+        self.sfqid = None
+        self._rows = []
+
+    def execute(self, sql, params=None):
+        self.conn.executed.append(sql)
+        for fail in self.conn.fail_on:
+            # either a substring (fails with a RuntimeError) or (substring, exception)
+            (substr, exc) = fail if isinstance(fail, tuple) else (fail, RuntimeError("fake failure for %s" % fail))
+            if substr in sql:
+                raise exc
+        self._rows = []
+        self.description = None
+        for (prefix, description, rows) in self.conn.answers:
+            if sql.startswith(prefix):
+                self.description = description
+                self._rows = list(rows)
+                break
+        self.rowcount = len(self._rows)
+
+    def fetchone(self):
+        return self._rows.pop(0) if self._rows else None
+
+    def fetchall(self):
+        (rows, self._rows) = (self._rows, [])
+        return rows
+
+    def fetchmany(self, n):
+        (rows, self._rows) = (self._rows[:n], self._rows[n:])
+        return rows
+
+    def close(self):
+        return
+
+
+class FakeConnection:
+    def __init__(self, answers=None, fail_on=None):
+        self.answers = answers or []
+        self.fail_on = fail_on or []
+        self.executed = []
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def close(self):
+        return
+
+
+class FakeValidator:
+    def __init__(self):
+        self.records = []
+
+    def queue_record(self, r):
+        self.records.append(r)
+
+    def queue_metadata(self, m):
+        return
+
+    def queue_commit(self):
+        return (1, { 'had_error': False })
+
+
+@pytest.fixture
+def validator(config, monkeypatch):
+    v = FakeValidator()
+    monkeypatch.setattr(config, 'connect_controller', lambda table, timeshift=0: v)
+    return v
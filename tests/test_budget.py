@@ -0,0 +1,106 @@
+import re
+
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import sfdatalake
+
+from conftest import FakeConnection
+
+
+T0 = datetime(2021, 1, 1, tzinfo=timezone.utc)
+MAX = T0 + timedelta(days=10)
+
+COLUMNS = [('T', 'PUBLIC', 'ID', '{"type":"FIXED","scale":0}'),
+           ('T', 'PUBLIC', 'TS', '{"type":"TIMESTAMP_LTZ","scale":9}')]
+
+EXPLAIN = ('EXPLAIN', [('operation',), ('partitionsTotal',), ('partitionsAssigned',), ('bytesAssigned',)],
+           [('GlobalStats', 100, 80, 500)])
+
+
+def _proportional(frac):
+    return 500 * frac
+
+
+@pytest.fixture
+def bytes_for_window(monkeypatch):
+    """EXPLAIN estimates: what the connection answers for the whole table, a
+    sample's share of 500 bytes, and bytes_for_window[0](fraction of the TS
+    range) for a window."""
+    shape = [_proportional]
+    real_explain = sfdatalake.ExplainSql
+
+    def explain(table, config, cs, sql):
+        m = re.search(r"SAMPLE SYSTEM \((.*?)\)", sql)
+        if m:
+            return { 'bytesAssigned': int(500 * float(m.group(1)) / 100) }
+        m = re.search(r"AND TS <= '(.*?)'", sql)
+        if m:
+            frac = (datetime.fromisoformat(m.group(1)) - T0) / (MAX - T0)
+            return { 'bytesAssigned': int(shape[0](frac)) }
+        return real_explain(table, config, cs, sql)
+
+    monkeypatch.setattr(sfdatalake, 'ExplainSql', explain)
+    return shape
+
+
+def _plan(config, t_options, marker_pair):
+    conn = FakeConnection(answers=[EXPLAIN])
+    return sfdatalake.PlanFetch('T', config, conn.cursor(), ['ID', 'TS'], 'TS', None, t_options,
+                                marker_pair, MAX)
+
+
+def test_within_budget(config):
+    (sql, _c, _l, window_end, sample_pct, estimate, _note) = _plan(config, { 'max_bytes_scanned': 1000 }, ('TS', T0))
+    assert 'SAMPLE' not in sql and window_end is None and sample_pct is None
+    assert estimate == { 'partitionsTotal': 100, 'partitionsAssigned': 80, 'bytesAssigned': 500 }
+
+
+def test_sample_without_marker(config, bytes_for_window):
+    (sql, _c, _l, window_end, sample_pct, _e, _note) = _plan(config, { 'max_bytes_scanned': 100 }, None)
+    assert sample_pct == 20.0 and window_end is None
+    assert 'SAMPLE SYSTEM (20.0)' in sql
+
+
+def test_marker_reads_a_window_instead_of_sampling(config, bytes_for_window):
+    (sql, _c, _l, window_end, sample_pct, _e, _note) = _plan(config, { 'max_bytes_scanned': 100 }, ('TS', T0))
+    assert sample_pct is None
+    assert window_end == T0 + timedelta(days=2)
+    assert "AND TS <= '%s'" % window_end in sql and 'SAMPLE' not in sql
+
+
+def test_marker_without_window_skips(config):
+    (sql, _c, _l, _w, sample_pct, _e, note) = _plan(config, { 'max_bytes_scanned': 100 }, ('OTHER_COL', T0))
+    assert sql is None and sample_pct is None
+    assert 'skipping' in note
+
+
+def test_sampled_read_keeps_marker_where_it_was(config, validator, bytes_for_window):
+    conn = FakeConnection(answers=[('show columns', None, COLUMNS),
+                                   ('select max', None, [(MAX,)]),
+                                   ('select min', None, [(T0,)]),
+                                   ('select count', None, [(10,)]),
+                                   EXPLAIN,
+                                   ('select ID, TS from T', None, [(2, MAX), (1, T0)])])
+
+    sfdatalake.FetchTable('T', config, conn, 'TS', None, { 'max_bytes_scanned': 100 })
+
+    assert any('SAMPLE SYSTEM' in sql for sql in conn.executed)
+    assert len(validator.records) == 2
+    assert not config.get_session_history().has_history('T')
+
+
+def test_window_still_over_budget_shrinks(config, bytes_for_window):
+    # most of the bytes sit just after the marker, so the straight-line guess is far too wide
+    bytes_for_window[0] = lambda frac: 500 if frac > 0.1 else 500 * frac
+    (sql, _c, _l, window_end, _s, _e, _note) = _plan(config, { 'max_bytes_scanned': 100 }, ('TS', T0))
+    assert window_end == T0 + timedelta(days=0.4)
+    assert "AND TS <= '%s'" % window_end in sql
+
+
+def test_window_that_never_fits_skips(config, bytes_for_window):
+    bytes_for_window[0] = lambda frac: 500
+    (sql, _c, _l, window_end, sample_pct, _e, note) = _plan(config, { 'max_bytes_scanned': 100 }, ('TS', T0))
+    assert sql is None and window_end is None and sample_pct is None
+    assert 'skipping' in note
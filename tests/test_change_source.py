@@ -0,0 +1,55 @@
+import pytest
+
+import sfdatalake
+
+from snowflake.connector.errors import OperationalError, ProgrammingError
+
+from conftest import FakeConnection
+
+
+COLUMNS = [('T', 'PUBLIC', 'ID', '{"type":"FIXED","scale":0}')]
+
+
+def test_stale_changes_marker_starts_over(config, validator):
+    h = config.get_session_history()
+    h.add_history('T', sfdatalake.CHANGES_MARKER, '2020-01-01 00:00:00.000000000 +00:00')
+    h.save()
+
+    conn = FakeConnection(answers=[('show columns', None, COLUMNS),
+                                   ('select to_varchar(current_timestamp()', None, [('2021-06-01 00:00:00.000000000 +00:00',)]),
+                                   ('select ID from T', None, [(1,), (2,)])],
+                          fail_on=[("AT(TIMESTAMP => to_timestamp_tz('2020-01-01",
+                                    ProgrammingError(msg="Time travel data is not available for table T", errno=707))])
+
+    sfdatalake.FetchTable('T', config, conn, None, 10, { 'change_source': 'changes' })
+
+    selects = [sql for sql in conn.executed if sql.startswith('select ID from T')]
+    assert len(selects) == 2
+    assert 'CHANGES' not in selects[1] and selects[1].endswith('LIMIT 10')
+    assert [r['ID'] for r in validator.records] == [1, 2]
+    assert h.get_history('T') == (sfdatalake.CHANGES_MARKER, '2021-06-01 00:00:00.000000000 +00:00')
+
+
+@pytest.mark.parametrize("exc", [RuntimeError("connection reset"),
+                                 OperationalError(msg="Statement reached its statement or warehouse timeout", errno=630)])
+def test_other_changes_errors_keep_marker(config, validator, exc):
+    h = config.get_session_history()
+    h.add_history('T', sfdatalake.CHANGES_MARKER, '2021-05-31 00:00:00.000000000 +00:00')
+    h.save()
+
+    conn = FakeConnection(answers=[('show columns', None, COLUMNS),
+                                   ('select to_varchar(current_timestamp()', None, [('2021-06-01 00:00:00.000000000 +00:00',)]),
+                                   ('select ID from T', None, [(1,), (2,)])],
+                          fail_on=[("AT(TIMESTAMP => to_timestamp_tz('2021-05-31", exc)])
+
+    with pytest.raises(type(exc)):
+        sfdatalake.FetchTable('T', config, conn, None, 10, { 'change_source': 'changes' })
+
+    assert not [sql for sql in conn.executed if sql.endswith('LIMIT 10')]
+    assert validator.records == []
+
+    reloaded = sfdatalake.Config()
+    reloaded._d = config._d
+    reloaded.get_session_history().load()
+    assert reloaded.get_session_history().get_history('T') == \
+           (sfdatalake.CHANGES_MARKER, '2021-05-31 00:00:00.000000000 +00:00')
@@ -0,0 +1,175 @@
+import time
+
+import pytest
+
+import sfdatalake
+
+
+KEYS = ['pipeline/T%d' % i for i in range(200)]
+
+
+def test_rendezvous_owner_is_stable():
+    before = dict((k, sfdatalake.RendezvousOwner(k, ['a', 'b', 'c'])) for k in KEYS)
+    assert before == dict((k, sfdatalake.RendezvousOwner(k, ['c', 'b', 'a'])) for k in KEYS)
+    assert set(before.values()) == set(['a', 'b', 'c'])
+
+    # adding a host only moves keys onto the new host
+    after = dict((k, sfdatalake.RendezvousOwner(k, ['a', 'b', 'c', 'd'])) for k in KEYS)
+    for k in KEYS:
+        assert after[k] in (before[k], 'd')
+
+
+def test_parse_shard():
+    assert sfdatalake.ParseShard("0/3") == (0, 3)
+    assert sfdatalake.ParseShard("2/3") == (2, 3)
+    for bad in ["3/3", "-1/3", "1", "a/b", "0/0"]:
+        with pytest.raises(SystemExit):
+            sfdatalake.ParseShard(bad)
+
+
+def _store(tmp_path, owner, ttl=60):
+    s = sfdatalake.SQLiteLeaseStore(str(tmp_path / "leases.db"), owner, ttl)
+    s.join()
+    return s
+
+
+def _claims(store, members):
+    return set(k for k in KEYS if store.claim(k, members))
+
+
+def test_two_owners_split_tables(tmp_path):
+    a = _store(tmp_path, 'a')
+    b = _store(tmp_path, 'b')
+    members = a.live_members()
+    assert members == ['a', 'b'] == b.live_members()
+
+    a_claims = _claims(a, members)
+    b_claims = _claims(b, members)
+    assert a_claims and b_claims
+    assert a_claims.isdisjoint(b_claims)
+    assert a_claims | b_claims == set(KEYS)
+
+
+def test_claim_blocked_until_expiry(tmp_path):
+    a = _store(tmp_path, 'a', ttl=1)
+    b = _store(tmp_path, 'b', ttl=1)
+    key = KEYS[0]
+    assert a._try_claim(key)
+    assert not b._try_claim(key)
+    time.sleep(1.2)
+    assert b._try_claim(key)
+
+
+def test_dead_owner_tables_move(tmp_path):
+    a = _store(tmp_path, 'a', ttl=1)
+    b = _store(tmp_path, 'b', ttl=1)
+    members = a.live_members()
+    _claims(a, members)
+    _claims(b, members)
+
+    # a stops renewing; b keeps going.
+    time.sleep(1.2)
+    b.renew_all()
+    members = b.live_members()
+    assert members == ['b']
+    assert _claims(b, members) == set(KEYS)
+
+
+def test_new_host_gets_tables_handed_over(tmp_path):
+    a = _store(tmp_path, 'a')
+    a_claims = _claims(a, a.live_members())
+    assert a_claims == set(KEYS)
+
+    b = _store(tmp_path, 'b')
+    members = b.live_members()
+    moving = set(k for k in KEYS if sfdatalake.RendezvousOwner(k, members) == 'b')
+    assert moving
+
+    # b can't take them yet, a's leases are still live ...
+    assert _claims(b, members) == set()
+
+    # ... but a reads them one more time and then lets them go.
+    a2 = _store(tmp_path, 'a')
+    assert _claims(a2, a2.live_members()) == set(KEYS)
+    for k in KEYS:
+        a2.finished(k)
+
+    assert _claims(b, members) == moving
+    assert _claims(a2, a2.live_members()) == set(KEYS) - moving
+
+
+def test_save_writes_only_changed_markers(config):
+    h1 = config.get_session_history()
+    h1.add_history('T1', 'TS', 1)
+    h1.add_history('T2', 'TS', 1)
+    h1.save()
+
+    # a second host sharing the cache file
+    other = sfdatalake.SessionHistory()
+    other.set_config(config)
+    other.load()
+    other.add_history('T2', 'TS', 5)
+    other.save()
+
+    # we move T1 only; our stale T2 must not be written back
+    h1.add_history('T1', 'TS', 2)
+    h1.save()
+
+    check = sfdatalake.SessionHistory()
+    check.set_config(config)
+    check.load()
+    assert check.get_history('T1') == ('TS', 2)
+    assert check.get_history('T2') == ('TS', 5)
+
+
+def _host_config(config, tmp_path, name):
+    # same yaml, but each host has its own local cache file
+    c = sfdatalake.Config()
+    c._d = dict(config._d)
+    c._d['configuration'] = dict(config._d['configuration'])
+    c._d['configuration']['session_history_cache'] = str(tmp_path / ("%s.db" % name))
+    return c
+
+
+def test_marker_moves_with_lease(config, tmp_path):
+    key = sfdatalake.ShardKey(config, 'T')
+
+    a = _store(tmp_path, 'a', ttl=1)
+    a_config = _host_config(config, tmp_path, 'a')
+    a_config.get_session_history().set_lease_store(a)
+    assert a.claim(key, ['a'])
+    assert a_config.get_session_history().get_history('T') is None
+    a_config.get_session_history().add_history('T', 'TS', 42)
+    a_config.get_session_history().save()
+
+    # a goes away; b has never seen the table but picks up a's marker with the lease.
+    time.sleep(1.2)
+    b = _store(tmp_path, 'b', ttl=1)
+    b_config = _host_config(config, tmp_path, 'b')
+    b_config.get_session_history().set_lease_store(b)
+    assert b.claim(key, b.live_members())
+    assert b_config.get_session_history().get_history('T') == ('TS', 42)
+
+    # a comes back late and tries to save an older marker; it no longer holds the lease.
+    a_config.get_session_history().add_history('T', 'TS', 40)
+    a_config.get_session_history().save()
+    b.renew_all()
+    assert b._load_marker(key) == ('TS', 42)
+
+
+def test_handover_keeps_marker(config, tmp_path):
+    key = next(k for k in ('pipeline/DB/T%d' % i for i in range(100)) if sfdatalake.RendezvousOwner(k, ['a', 'b']) == 'b')
+    a = _store(tmp_path, 'a')
+    assert a.claim(key, a.live_members())
+    assert a.save_marker(key, 'TS', 7)
+
+    # b joins; a reads the table once more, moves the marker, and hands it over.
+    b = _store(tmp_path, 'b')
+    assert not b.claim(key, b.live_members())
+    assert a.claim(key, a.live_members())
+    assert a.get_marker(key) == ('TS', 7)
+    assert a.save_marker(key, 'TS', 8)
+    a.finished(key)
+
+    assert b.claim(key, b.live_members())
+    assert b.get_marker(key) == ('TS', 8)
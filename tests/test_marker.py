@@ -0,0 +1,41 @@
+from datetime import datetime, timedelta, timezone
+
+import sfdatalake
+
+from conftest import FakeConnection
+
+
+NOW = datetime.now(timezone.utc)
+ROWS = [(i, NOW - timedelta(hours=i)) for i in range(5)] # newest first, as ORDER BY TS DESC returns them
+
+COLUMNS = [('T', 'PUBLIC', 'ID', '{"type":"FIXED","scale":0}'),
+           ('T', 'PUBLIC', 'TS', '{"type":"TIMESTAMP_LTZ","scale":9}')]
+
+
+def _conn(rows):
+    return FakeConnection(answers=[('show columns', None, COLUMNS),
+                                   ('select max', None, [(ROWS[0][1],)]),
+                                   ('select min', None, [(ROWS[-1][1],)]),
+                                   ('select count', None, [(len(ROWS),)]),
+                                   ('select ID, TS from T', None, rows)])
+
+
+def test_marker_is_newest_row_read(config, validator):
+    conn = _conn(ROWS)
+    sfdatalake.FetchTable('T', config, conn, 'TS', 3, {})
+
+    assert config.get_session_history().get_history('T') == ('TS', ROWS[0][1])
+    assert [sql for sql in conn.executed if sql.startswith('select ID')][0].endswith('ORDER BY TS DESC LIMIT 3')
+
+
+def test_next_run_reads_only_newer_rows(config, validator):
+    sfdatalake.FetchTable('T', config, _conn(ROWS), 'TS', 3, {})
+
+    conn = _conn([])
+    sfdatalake.FetchTable('T', config, conn, 'TS', 3, {})
+
+    sql = [sql for sql in conn.executed if sql.startswith('select ID')][0]
+    assert "WHERE TS > '%s'" % ROWS[0][1] in sql
+    assert 'LIMIT' not in sql
+    # nothing new; the marker stays put
+    assert config.get_session_history().get_history('T') == ('TS', ROWS[0][1])
@@ -0,0 +1,65 @@
+import glob
+import inspect
+import os
+import tracemalloc
+
+import sfdatalake
+
+
+def _work(n):
+    # a few allocation sites for the memory report to list
+    a = [str(i) for i in range(n)]
+    b = [(i, i) for i in range(n)]
+    c = dict((i, [i]) for i in range(n))
+    return len(a) + len(b) + len(c)
+
+
+def _section(lines, title):
+    i = lines.index(title)
+    out = []
+    for line in lines[i + 1:]:
+        if not line.strip():
+            break
+        out.append(line)
+    return out
+
+
+def test_cpu_and_mem_profiles(config):
+    assert sfdatalake.RunProfiled(config, 'DB.PUBLIC.T', True, True, 3, _work, 20000) == 60000
+    assert not tracemalloc.is_tracing()
+
+    profile_dir = os.path.join(os.path.dirname(config.get_sf_local_cache_file()), "profiles")
+    (prof,) = glob.glob(os.path.join(profile_dir, "DB.PUBLIC.T-*.prof"))
+    base_path = prof[:-len(".prof")]
+
+    with open(base_path + ".cpu.txt") as f:
+        cpu = f.read()
+    assert "CPU profile for DB.PUBLIC.T" in cpu
+    # once sorted by cumulative time, once by self time
+    assert cpu.count("due to restriction <3>") == 2
+    assert "_work" in cpu
+
+    with open(base_path + ".mem.txt") as f:
+        lines = f.read().splitlines()
+    held = _section(lines, "Largest allocations still held at the end of the fetch:")
+    assert len(held) == 3
+    changed = _section(lines, "Largest changes over the fetch:")
+    assert len(changed) == 3
+
+
+def test_mem_profile_leaves_out_cpu_profile_dump(config):
+    # the memory snapshot is taken before the cpu profile is written, so
+    # _write_cpu_profile's allocations don't show up even in a long list
+    sfdatalake.RunProfiled(config, 'T', True, True, 1000, _work, 10)
+    (mem,) = glob.glob(os.path.join(os.path.dirname(config.get_sf_local_cache_file()), "profiles", "T-*.mem.txt"))
+    with open(mem) as f:
+        report = f.read()
+
+    (source, first) = inspect.getsourcelines(sfdatalake._write_cpu_profile)
+    for n in range(first, first + len(source)):
+        assert "sfdatalake.py:%d:" % n not in report
+
+
+def test_no_profiling_runs_plain(config):
+    assert sfdatalake.RunProfiled(config, 'T', False, False, 3, _work, 10) == 30
+    assert not os.path.exists(os.path.join(os.path.dirname(config.get_sf_local_cache_file()), "profiles"))
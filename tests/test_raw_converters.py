@@ -0,0 +1,64 @@
+from decimal import Decimal
+
+import pytest
+
+import sfdatalake
+
+converter = pytest.importorskip("snowflake.connector.converter")
+
+
+def _type(sf_type, scale=None):
+    if scale is None:
+        return '{"type":"%s","nullable":true}' % sf_type
+    return '{"type":"%s","precision":38,"scale":%d,"nullable":true}' % (sf_type, scale)
+
+
+# (SHOW COLUMNS type, connector column description, raw JSON values)
+CASES = [
+    (_type('FIXED', 0),          'FIXED',         {'scale': 0},  ['0', '42', '-7', '123456789012345678901234567890']),
+    (_type('FIXED', 2),          'FIXED',         {'scale': 2},  ['12.34', '-0.50', '0.00']),
+    (_type('REAL'),              'REAL',          {},            ['1.5', '-2.25e10', '0']),
+    (_type('DATE'),              'DATE',          {},            ['0', '18628', '-1']),
+    (_type('BOOLEAN'),           'BOOLEAN',       {},            ['1', '0', 'TRUE', 'FALSE']),
+    (_type('TIME', 9),           'TIME',          {'scale': 9},  ['3661.250000000', '0.000000000', '86399.999999000']),
+    (_type('TIMESTAMP_NTZ', 9),  'TIMESTAMP_NTZ', {'scale': 9},  ['1616161616.123456000', '0.000000000', '-1.500000000']),
+    (_type('TIMESTAMP_LTZ', 9),  'TIMESTAMP_LTZ', {'scale': 9},  ['1616161616.123456000', '-1.500000000']),
+    (_type('TIMESTAMP_TZ', 9),   'TIMESTAMP_TZ',  {'scale': 9},  ['1616161616.123456000 1440', '1616161616.500000000 1500',
+                                                                 '1616161616.000000000 1080']),
+]
+
+
+@pytest.mark.parametrize("field_type, type_name, column, values", CASES)
+def test_raw_converter_matches_connector(field_type, type_name, column, values):
+    ours = sfdatalake.RawConverterForType(field_type)
+    theirs = converter.SnowflakeConverter().to_python_method(type_name, column)
+    for v in values:
+        mine = ours(v)
+        expected = theirs(v)
+        assert mine == expected, v
+        assert type(mine) == type(expected), v
+        if type_name == 'TIMESTAMP_TZ':
+            assert mine.utcoffset() == expected.utcoffset(), v
+    # endfor
+
+
+def test_binary_and_text():
+    assert sfdatalake.RawConverterForType(_type('BINARY'))('48656c6c6f') == b'Hello'
+    assert sfdatalake.RawConverterForType(_type('TEXT')) is None
+    assert sfdatalake.RawConverterForType(_type('VARIANT')) is None
+    assert sfdatalake.RawConverterForType('not json') is None
+
+
+def test_typed_columns_match_any_case(caplog):
+    field_names = ['ID', 'AMOUNT', 'UPDATED_AT', 'NOTE']
+    field_types = { 'ID': _type('FIXED', 0),
+                    'AMOUNT': _type('FIXED', 2),
+                    'UPDATED_AT': _type('TIMESTAMP_LTZ', 9),
+                    'NOTE': _type('TEXT') }
+
+    converters = sfdatalake.BuildRawConverters('T', field_names, field_types, ['amount', 'Updated_At', 'missing'])
+
+    assert [i for (i, _fn) in converters] == [1, 2]
+    assert converters[0][1]('1.25') == Decimal('1.25')
+    assert converters[1][1]('0.000000000').tzinfo is not None
+    assert 'MISSING' in caplog.text
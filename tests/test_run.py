@@ -0,0 +1,37 @@
+import pytest
+
+import sfdatalake
+
+from conftest import FakeConnection
+
+
+@pytest.mark.parametrize("profile_cpu, profile_mem", [(True, False), (False, True)])
+def test_profiling_needs_concurrency_1(profile_cpu, profile_mem):
+    with pytest.raises(SystemExit):
+        sfdatalake.do_run(["unused.yaml"], None, False, profile_cpu=profile_cpu, profile_mem=profile_mem,
+                          concurrency=2)
+
+
+
+def test_pooled_session_does_not_carry_warehouse_across_configs(config, validator, monkeypatch):
+    conn = FakeConnection(answers=[('select current_warehouse()', None, [('DEFAULT_WH',)]),
+                                   ('show columns', None, [('T', 'PUBLIC', 'ID', '{"type":"FIXED","scale":0}')]),
+                                   ('select ID from', None, [])])
+    monkeypatch.setattr(sfdatalake.snowflake.connector, 'connect', lambda **kwargs: conn)
+
+    big = config
+    big._d['configuration']['warehouse'] = 'XL_WH'
+    small = sfdatalake.Config()
+    small._d = dict(config._d)
+    small._d['configuration'] = dict(config._d['configuration'])
+    small._d['configuration']['warehouse'] = None
+    monkeypatch.setattr(small, 'connect_controller', big.connect_controller)
+
+    pool = sfdatalake.SessionPool()
+    sfdatalake.RunTableJob(pool, None, big, 'BIG', None, 10, {}, False, False, 20)
+    del conn.executed[:]
+    sfdatalake.RunTableJob(pool, None, small, 'SMALL', None, 10, {}, False, False, 20)
+
+    # one login, and the second config's table is back on the session's own warehouse
+    assert conn.executed.count('select current_warehouse()') == 0
+    assert [sql for sql in conn.executed if sql.startswith('USE warehouse')] == ['USE warehouse DEFAULT_WH']
@@ -0,0 +1,75 @@
+import sfdatalake
+
+
+def test_normalize_sql_strips_literals():
+    a = sfdatalake.NormalizeSql("select a from T1 WHERE ts > '2021-01-01 00:00:00' LIMIT 10")
+    b = sfdatalake.NormalizeSql("select a from T1  WHERE ts > '2021-02-03 04:05:06' LIMIT 500")
+    assert a == b == "select a from T1 WHERE ts > ? LIMIT ?"
+
+
+def test_sql_log_summary_is_per_table(config):
+    h = config.get_session_history()
+    for i in range(5):
+        for t in ['A', 'B']:
+            h.append_sql_log(t, "select x from %s WHERE ts > '2021-01-0%d'" % (t, i + 1), duration=i, row_count=1)
+            h.append_sql_log(t, "show columns in %s" % t, duration=0.1)
+    # endfor
+
+    (slowest, frequent) = h.get_sql_log_summary(top_n=2)
+
+    assert [(r[0], r[1]) for r in slowest] == [('A', 4), ('A', 3), ('B', 4), ('B', 3)]
+    # the fetch runs group together even though the marker changes
+    assert ('A', 5, "select x from A WHERE ts > ?") in [(r[0], r[1], r[4]) for r in frequent]
+    assert len([r for r in frequent if r[0] == 'B']) == 2
+
+
+def test_sql_log_prune_keeps_newest_rows(config):
+    config._d['configuration']['sql_log_max_rows'] = 3
+    h = config.get_session_history()
+    for i in range(10):
+        h.append_sql_log('T', "select %d" % i)
+    h.prune_sql_log()
+
+    (_slowest, frequent) = h.get_sql_log_summary('T', top_n=10)
+    assert sum(r[1] for r in frequent) == 3
+
+
+def _config_for(config, database):
+    # another yaml using the same (default) cache file
+    c = sfdatalake.Config()
+    c._d = dict(config._d)
+    c._d['configuration'] = dict(config._d['configuration'])
+    c._d['configuration']['database'] = database
+    return c
+
+
+def test_markers_of_same_named_tables_stay_apart(config):
+    a = _config_for(config, 'DB_A')
+    b = _config_for(config, 'DB_B')
+    a.get_session_history().add_history('ORDERS', 'TS', 1)
+    a.get_session_history().save()
+    b.get_session_history().add_history('ORDERS', 'TS', 2)
+    b.get_session_history().save()
+
+    for (c, expected) in [(a, ('TS', 1)), (b, ('TS', 2))]:
+        h = _config_for(c, c.get_sf_database()).get_session_history()
+        h.load()
+        assert h.get_history('ORDERS') == expected
+
+
+def test_marker_saved_under_bare_table_name_still_loads(config):
+    h = config.get_session_history()
+    h.history['ORDERS'] = ('TS', 1)
+    h._dirty.add('ORDERS')
+    h.save()
+
+    reloaded = _config_for(config, 'DB').get_session_history()
+    reloaded.load()
+    assert reloaded.get_history('ORDERS') == ('TS', 1)
+
+    # the next save moves it under the new key
+    reloaded.add_history('ORDERS', 'TS', 2)
+    reloaded.save()
+    again = _config_for(config, 'DB').get_session_history()
+    again.load()
+    assert again.get_history('ORDERS') == ('TS', 2)
@@ -0,0 +1,86 @@
+import pytest
+
+import sfdatalake
+
+from conftest import FakeConnection
+
+
+TIERS = [{ 'warehouse': 'XS', 'max_rows': 1000 },
+         { 'warehouse': 'M', 'max_bytes': 10 ** 9 },
+         { 'warehouse': 'XL' }]
+
+SHOW_TABLES_COLUMNS = [('created_on',), ('name',), ('rows',), ('bytes',)]
+
+
+def _choose(config, rows, nbytes, t_options=None):
+    conn = FakeConnection(answers=[('SHOW TABLES', SHOW_TABLES_COLUMNS, [('2021', 'T', rows, nbytes)])])
+    return sfdatalake.ChooseWarehouse('T', config, conn.cursor(), t_options or {})
+
+
+@pytest.mark.parametrize("rows, nbytes, expected", [
+    (10, 100, 'XS'),
+    (10 ** 6, 100, 'M'),
+    (10 ** 6, 10 ** 12, 'XL'),
+    # fetch_mode: raw returns SHOW output as strings
+    ('10', '100', 'XS'),
+    ('5000', '123456', 'M'),
+])
+def test_warehouse_tiers(config, rows, nbytes, expected):
+    config._d['configuration']['warehouse_tiers'] = TIERS
+    assert _choose(config, rows, nbytes) == expected
+
+
+def test_table_warehouse_wins(config):
+    config._d['configuration']['warehouse_tiers'] = TIERS
+    assert _choose(config, 10, 100, { 'warehouse': 'OVERRIDE' }) == 'OVERRIDE'
+
+
+def test_shared_storage_lookup_is_normalised(config):
+    # a raw-mode config fills the shared entry; a default-mode one reads it
+    raw = FakeConnection(answers=[('SHOW TABLES', SHOW_TABLES_COLUMNS, [('x', 'T', '5000', '123456')])])
+    config._d['configuration']['fetch_mode'] = 'raw'
+    assert sfdatalake.GetTableStorage('T', config, raw.cursor()) == (5000, 123456)
+
+    other = sfdatalake.Config()
+    other._d['configuration'].update(config._d['configuration'])
+    other._d['configuration']['fetch_mode'] = 'default'
+    unused = FakeConnection()
+    assert sfdatalake.GetTableStorage('T', other, unused.cursor()) == (5000, 123456)
+    assert unused.executed == []
+
+
+def test_table_warehouse_does_not_stick_to_the_session(config, validator, monkeypatch):
+    # no warehouse in the configuration: the session starts on the user's default
+    conn = FakeConnection(answers=[('select current_warehouse()', None, [('DEFAULT_WH',)]),
+                                   ('show columns', None, [('T', 'PUBLIC', 'ID', '{"type":"FIXED","scale":0}')]),
+                                   ('select ID from', None, [])])
+    monkeypatch.setattr(sfdatalake.snowflake.connector, 'connect', lambda **kwargs: conn)
+    config._d['configuration']['warehouse'] = None
+    sf_context = sfdatalake.ConnectToSnowflake(config)
+
+    sfdatalake.FetchTable('BIG', config, sf_context, None, 10, { 'warehouse': 'XL_WH' })
+    del conn.executed[:]
+    sfdatalake.FetchTable('SMALL', config, sf_context, None, 10, {})
+
+    uses = [sql for sql in conn.executed if sql.startswith('USE warehouse')]
+    assert uses == ['USE warehouse DEFAULT_WH']
+
+
+SHOW_TABLES_SCHEMA_COLUMNS = [('created_on',), ('name',), ('schema_name',), ('rows',), ('bytes',)]
+
+
+@pytest.mark.parametrize("table, expected", [
+    ('MY_TABLE', (10, 100)),
+    ('my_table', (10, 100)),
+    ('OTHER.MY_TABLE', (30, 300)),
+    ('DB.OTHER.MY_TABLE', (30, 300)),
+    ('NOPE', (None, None)),
+])
+def test_storage_matches_exact_name_and_schema(config, table, expected):
+    # LIKE 'MY_TABLE' also matches MYXTABLE, and IN DATABASE looks in every schema
+    conn = FakeConnection(answers=[('SHOW TABLES', SHOW_TABLES_SCHEMA_COLUMNS,
+                                    [('x', 'MYXTABLE', 'PUBLIC', 99, 999),
+                                     ('x', 'MY_TABLE', 'OTHER', 30, 300),
+                                     ('x', 'MY_TABLE', 'PUBLIC', 10, 100)])])
+    assert sfdatalake.GetTableStorage(table, config, conn.cursor()) == expected
+    assert "LIKE '%s'" % table.split(".")[-1].replace("_", "\\\\_") in conn.executed[0]